@@ -0,0 +1,36 @@
+"""Helpers shared by the benchmark scripts.
+
+import_bot() must run before anything else touches bot.py: importing it creates
+the session and log files in the working directory, so it is imported from a
+throwaway directory. START_DIR keeps the directory the script was started from,
+for resolving file arguments afterwards.
+"""
+import importlib
+import os
+import string
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+START_DIR = os.getcwd()
+
+
+def import_bot(prefix):
+    sys.path.insert(0, REPO_ROOT)
+    os.chdir(tempfile.mkdtemp(prefix=f"{prefix}_"))
+    return importlib.import_module("bot")
+
+
+def random_word(rng, shortest=4, longest=10):
+    return "".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(shortest, longest)))
+
+
+def timed(fn, *args, repeat=3):
+    # Best of several runs, which is the least disturbed by the rest of the machine
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
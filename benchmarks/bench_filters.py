@@ -0,0 +1,78 @@
+"""Compare the per-word blacklist/blocked-sentence filters with the compiled matcher.
+
+Usage: python benchmarks/bench_filters.py [--words 10000] [--messages 500]
+"""
+import argparse
+import random
+import time
+
+from _common import import_bot, random_word, timed
+
+bot = import_bot("bench_filters")
+
+
+def filter_words(rng):
+    return random_word(rng, 5, 12)
+
+
+def make_messages(rng, vocabulary, blacklist, count):
+    messages = []
+    for _ in range(count):
+        words = [rng.choice(vocabulary) for _ in range(rng.randint(20, 120))]
+        # Roughly one message in five contains a filtered word
+        if rng.random() < 0.2:
+            words[rng.randrange(len(words))] = rng.choice(blacklist)
+        messages.append(" ".join(words).capitalize())
+    return messages
+
+
+def filter_all(fn, messages):
+    for text in messages:
+        fn(text)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--words", type=int, default=10000, help="entries in each list")
+    parser.add_argument("--messages", type=int, default=500, help="messages per run")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per measurement, best is reported")
+    parser.add_argument("--seed", type=int, default=1234)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    blacklist = sorted({filter_words(rng) for _ in range(args.words)})
+    sentences = sorted({f"{filter_words(rng)} {filter_words(rng)}" for _ in range(args.words)})
+    vocabulary = [filter_words(rng) for _ in range(5000)]
+    messages = make_messages(rng, vocabulary, blacklist + sentences, args.messages)
+
+    start = time.perf_counter()
+    matchers = bot.compile_matchers({'blacklist': blacklist, 'blocked_sentences': sentences})
+    build_time = time.perf_counter() - start
+
+    mismatches = sum(
+        bot.filter_blacklisted_words(text, blacklist) != matchers.filter_blacklist(text)
+        or bot.check_blocked_sentences(text, sentences)[0] != bool(matchers.find_blocked_sentence(text))
+        for text in messages
+    )
+
+    results = [
+        ("blacklist", "filter_blacklisted_words",
+         timed(filter_all, lambda text: bot.filter_blacklisted_words(text, blacklist), messages, repeat=args.repeat),
+         timed(filter_all, matchers.filter_blacklist, messages, repeat=args.repeat)),
+        ("blocked sentences", "check_blocked_sentences",
+         timed(filter_all, lambda text: bot.check_blocked_sentences(text, sentences), messages, repeat=args.repeat),
+         timed(filter_all, matchers.find_blocked_sentence, messages, repeat=args.repeat)),
+    ]
+
+    print(f"{len(blacklist)} blacklist words, {len(sentences)} blocked sentences, {len(messages)} messages")
+    print(f"matcher build time: {build_time * 1000:.1f} ms, mismatching results: {mismatches}")
+    for label, legacy_name, legacy, compiled in results:
+        print(
+            f"{label:>18}: {legacy_name} {legacy / len(messages) * 1e6:9.1f} us/msg"
+            f" | matcher {compiled / len(messages) * 1e6:7.1f} us/msg"
+            f" | x{legacy / compiled:.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
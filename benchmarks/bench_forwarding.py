@@ -0,0 +1,276 @@
+"""Drive the forwarding handlers end to end against a fake Telegram client.
+
+Feeds a synthetic stream of new messages, albums, replies and edits through
+bot.forward_messages and bot.handle_message_edit, with every RPC answered by
+FakeClient after a configurable latency (and an occasional FloodWaitError).
+Nothing touches the network, and a fixed seed gives the same stream every run.
+
+Usage: python benchmarks/bench_forwarding.py [--messages 5000] [--pairs 8] [--latency-ms 20]
+
+The album, coalescing and edit windows are shortened (see --window-ms) and the
+send rate limits raised, so the run measures the bot rather than its timers;
+pass --real-limits to keep the production rate limits.
+"""
+import argparse
+import asyncio
+import itertools
+import logging
+import os
+import random
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+from telethon import errors
+
+from _common import import_bot, random_word
+
+bot = import_bot("bench_forwarding")
+
+
+class FakeMedia:
+    pass
+
+
+class FakeClient:
+    """Stands in for TelegramClient: every RPC sleeps, may flood-wait, and is counted."""
+
+    def __init__(self, rng, latency, jitter, flood_rate, flood_seconds):
+        self.rng = rng
+        self.latency = latency
+        self.jitter = jitter
+        self.flood_rate = flood_rate
+        self.flood_seconds = flood_seconds
+        self.calls = Counter()
+        self.floods = 0
+        self.in_flight = 0
+        self.next_ids = Counter()
+
+    async def _rpc(self, method):
+        self.calls[method] += 1
+        self.in_flight += 1
+        try:
+            await asyncio.sleep(max(0.0, self.rng.gauss(self.latency, self.jitter)))
+            if self.flood_rate and self.rng.random() < self.flood_rate:
+                self.floods += 1
+                raise errors.FloodWaitError(None, capture=self.flood_seconds)
+        finally:
+            self.in_flight -= 1
+
+    def _sent(self, destination):
+        self.next_ids[destination] += 1
+        return SimpleNamespace(id=self.next_ids[destination])
+
+    def is_connected(self):
+        return True
+
+    async def send_message(self, entity, message="", **kwargs):
+        await self._rpc("send_message")
+        return self._sent(entity)
+
+    async def send_file(self, entity, file, **kwargs):
+        await self._rpc("send_file")
+        return [self._sent(entity) for _ in file]
+
+    async def forward_messages(self, entity, messages, from_peer=None, **kwargs):
+        await self._rpc("forward_messages")
+        return [self._sent(entity) for _ in messages]
+
+    async def edit_message(self, entity, message=None, text=None, **kwargs):
+        await self._rpc("edit_message")
+        return SimpleNamespace(id=message)
+
+    async def delete_messages(self, entity, message_ids, **kwargs):
+        await self._rpc("delete_messages")
+
+    async def get_messages(self, entity, ids=None, limit=None, **kwargs):
+        await self._rpc("get_messages")
+        return [] if ids is None else [None for _ in ids]
+
+    async def iter_messages(self, entity, **kwargs):
+        await self._rpc("iter_messages")
+        return
+        yield
+
+
+def make_mappings(rng, args):
+    blacklist = sorted({random_word(rng) for _ in range(args.blacklist)})
+    sentences = sorted({f"{random_word(rng)} {random_word(rng)}" for _ in range(args.blacklist // 10)})
+    pairs = {}
+    for index in range(args.pairs):
+        source = -1000000000000 - index % args.sources
+        # Half the pairs filter text and go through send_message, the rest are plain server-side forwards
+        filtered = index % 2 == 0
+        pairs[f"pair{index}"] = bot.PairConfig(
+            str(source), str(-1000000001000 - index),
+            remove_mentions=filtered,
+            blacklist=blacklist if filtered else (),
+            blocked_sentences=sentences if filtered else ()
+        )
+    return {'1': pairs}, blacklist + sentences
+
+
+def make_stream(rng, args, sources, filtered_words):
+    # Yields ('new' | 'edit', message) in arrival order
+    vocabulary = [random_word(rng) for _ in range(2000)]
+    next_ids = Counter()
+    sent = {source: [] for source in sources}
+    group_ids = itertools.count(1)
+    emitted = 0
+    while emitted < args.messages:
+        source = rng.choice(sources)
+        if sent[source] and rng.random() < args.edit_rate:
+            original = rng.choice(sent[source][-200:])
+            edited = SimpleNamespace(**vars(original))
+            edited.text = edited.raw_text = original.text + " (edited)"
+            yield "edit", edited
+            continue
+
+        words = [rng.choice(vocabulary) for _ in range(rng.randint(5, 60))]
+        if rng.random() < 0.2:
+            words[rng.randrange(len(words))] = rng.choice(filtered_words)
+        if rng.random() < 0.1:
+            words.append(f"@{rng.choice(vocabulary)}")
+        text = " ".join(words)
+        reply_to = None
+        if sent[source] and rng.random() < args.reply_rate:
+            reply_to = SimpleNamespace(reply_to_msg_id=rng.choice(sent[source][-200:]).id)
+        size = rng.randint(2, 10) if rng.random() < args.album_rate else 1
+        grouped_id = next(group_ids) if size > 1 else None
+        for part in range(size):
+            next_ids[source] += 1
+            message = SimpleNamespace(
+                id=next_ids[source], chat_id=source,
+                text=text if part == 0 else "", raw_text=text if part == 0 else "",
+                media=FakeMedia() if grouped_id else None, grouped_id=grouped_id,
+                reply_to=reply_to, silent=False, entities=None, date=None
+            )
+            sent[source].append(message)
+            yield "new", message
+            emitted += 1
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def is_idle(client):
+    now = time.monotonic()
+    return not (
+        bot.pending_albums or bot.pending_forwards or bot.pending_edits or bot.pending_deletes
+        or client.in_flight or bot.send_scheduler.depth()
+        or any(lane.blocked_until > now for lane in bot.send_scheduler.lanes.values())
+    )
+
+
+async def run(args):
+    rng = random.Random(args.seed)
+    client = FakeClient(rng, args.latency_ms / 1000, args.jitter_ms / 1000, args.flood_rate, args.flood_seconds)
+    bot.client = client
+    bot.connected.set()
+    bot.init_state(os.path.join(os.getcwd(), "bench_state.db"))
+    bot.channel_mappings, filtered_words = make_mappings(rng, args)
+    bot.pair_stats = {
+        user_id: {name: bot.PairStats() for name in pairs}
+        for user_id, pairs in bot.channel_mappings.items()
+    }
+    bot.rebuild_routes()
+    if not args.real_limits:
+        bot.SEND_RATE_PER_DESTINATION = bot.GLOBAL_SEND_RATE = 1e9
+        bot.SEND_BURST_PER_DESTINATION = bot.GLOBAL_SEND_BURST = 1e9
+    window = args.window_ms / 1000
+    bot.ALBUM_WINDOW = bot.FORWARD_COALESCE_WINDOW = bot.EDIT_DEBOUNCE = bot.DELETE_BATCH_WINDOW = window
+    bot.send_scheduler = bot.SendScheduler()
+
+    dispatched = {}
+    latencies = []
+    observe_delivery = bot.observe_delivery
+
+    def record_delivery(message, user_id, pair_name):
+        latencies.append(time.perf_counter() - dispatched[message.chat_id, message.id])
+        observe_delivery(message, user_id, pair_name)
+
+    bot.observe_delivery = record_delivery
+
+    sources = sorted({mapping.source_id for mapping in bot.channel_mappings['1'].values()})
+    stream = list(make_stream(rng, args, sources, filtered_words))
+    interval = 1 / args.rate if args.rate else 0
+    counts = Counter(kind for kind, _ in stream)
+
+    if args.tracemalloc:
+        tracemalloc.start()
+    started = time.perf_counter()
+    for kind, message in stream:
+        message.date = datetime.now(timezone.utc)
+        event = SimpleNamespace(chat_id=message.chat_id, message=message)
+        if kind == "new":
+            dispatched[message.chat_id, message.id] = time.perf_counter()
+            await bot.forward_messages(event)
+        else:
+            await bot.handle_message_edit(event)
+        await asyncio.sleep(interval)
+    ingest_time = time.perf_counter() - started
+
+    while True:
+        await asyncio.sleep(window + 0.01)
+        if is_idle(client):
+            await asyncio.sleep(window + 0.01)
+            if is_idle(client):
+                break
+    elapsed = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1] if args.tracemalloc else None
+    if args.tracemalloc:
+        tracemalloc.stop()
+    bot.message_store.flush()
+
+    stats = Counter()
+    for pairs in bot.pair_stats.values():
+        for pair in pairs.values():
+            stats.update(dict(zip(pair.COUNTERS, pair.counts)))
+    rpcs = sum(client.calls.values())
+    print(f"{counts['new']} messages and {counts['edit']} edits over {len(sources)} sources, "
+          f"{args.pairs} pairs, {args.latency_ms:g} ms RPC latency")
+    print(f"ingest: {ingest_time:.2f} s, drained after {elapsed:.2f} s")
+    print(f"throughput: {counts['new'] / elapsed:,.0f} source msgs/s, {len(latencies) / elapsed:,.0f} deliveries/s")
+    print(f"delivery latency: p50 {percentile(latencies, 0.5) * 1000:.1f} ms, "
+          f"p99 {percentile(latencies, 0.99) * 1000:.1f} ms over {len(latencies)} deliveries")
+    print(f"pair totals: forwarded {stats['forwarded']}, edited {stats['edited']}, blocked {stats['blocked']}")
+    print(f"RPCs: {rpcs} ({rpcs / max(1, len(stream)):.2f} per event), "
+          + ", ".join(f"{method} {count}" for method, count in client.calls.most_common())
+          + f", flood waits injected {client.floods}")
+    if peak is not None:
+        print(f"peak traced memory: {peak / 1024 / 1024:.1f} MiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=5000, help="source messages to generate (album parts count individually)")
+    parser.add_argument("--pairs", type=int, default=8)
+    parser.add_argument("--sources", type=int, default=4)
+    parser.add_argument("--blacklist", type=int, default=5000, help="blacklist words per filtered pair")
+    parser.add_argument("--album-rate", type=float, default=0.05, help="fraction of posts that are albums")
+    parser.add_argument("--reply-rate", type=float, default=0.1)
+    parser.add_argument("--edit-rate", type=float, default=0.05)
+    parser.add_argument("--latency-ms", type=float, default=20, help="mean RPC latency")
+    parser.add_argument("--jitter-ms", type=float, default=5)
+    parser.add_argument("--flood-rate", type=float, default=0.001, help="probability an RPC raises FloodWaitError")
+    parser.add_argument("--flood-seconds", type=int, default=1)
+    parser.add_argument("--rate", type=float, default=0, help="arrival rate in events/s, 0 for as fast as possible")
+    parser.add_argument("--window-ms", type=float, default=50, help="album, coalescing and edit debounce windows")
+    parser.add_argument("--real-limits", action="store_true", help="keep the production send rate limits")
+    parser.add_argument("--no-tracemalloc", dest="tracemalloc", action="store_false",
+                        help="skip peak memory tracking, which slows the run down")
+    parser.add_argument("--seed", type=int, default=1234)
+    args = parser.parse_args()
+
+    logging.getLogger("ForwardBot").setLevel(logging.ERROR)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
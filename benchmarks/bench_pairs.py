@@ -0,0 +1,139 @@
+"""Compare memory and per-message lookups of plain-dict pairs with PairConfig/PairStats.
+
+Builds the same channel_mappings.json document for both representations: the
+dicts json.load gives back, and the slotted objects load_mappings builds from
+them. It then times the fields the forwarding path reads for every message.
+
+Usage: python benchmarks/bench_pairs.py [--pairs 10000] [--lookups 1000000]
+"""
+import argparse
+import gc
+import json
+import random
+import time
+import tracemalloc
+
+from _common import import_bot, random_word, timed
+
+bot = import_bot("bench_pairs")
+
+
+def make_document(rng, args):
+    # Most pairs have no filters, a few carry short lists, as in real mapping files
+    pairs = {}
+    for index in range(args.pairs):
+        filtered = rng.random() < args.filtered
+        pairs[f"pair{index}"] = {
+            'source': str(-1000000000000 - rng.randrange(args.sources)),
+            'destination': str(-1000000100000 - index),
+            'active': rng.random() < 0.9,
+            'remove_mentions': filtered,
+            'blacklist': sorted({random_word(rng) for _ in range(rng.randint(1, 20))}) if filtered else [],
+            'block_urls': False,
+            'header_pattern': '',
+            'footer_pattern': '',
+            'custom_header': '',
+            'custom_footer': '',
+            'blocked_sentences': [f"{random_word(rng)} {random_word(rng)}"] if filtered else [],
+            'drop_author': True,
+            'dedup': 'off'
+        }
+    return json.dumps({'1': pairs})
+
+
+def load_dicts(text):
+    mappings = json.loads(text)
+    stats = {
+        user_id: {
+            pair_name: {'forwarded': 0, 'edited': 0, 'blocked': 0, 'queued': 0, 'duplicates': 0, 'last_activity': None}
+            for pair_name in pairs
+        }
+        for user_id, pairs in mappings.items()
+    }
+    return mappings, stats
+
+
+def load_objects(text):
+    mappings = {
+        user_id: {pair_name: bot.PairConfig(**mapping) for pair_name, mapping in pairs.items()}
+        for user_id, pairs in json.loads(text).items()
+    }
+    stats = {user_id: {pair_name: bot.PairStats() for pair_name in pairs} for user_id, pairs in mappings.items()}
+    return mappings, stats
+
+
+def measure(load, text):
+    # Load time is taken without tracemalloc, which slows every allocation down
+    start = time.perf_counter()
+    load(text)
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    tracemalloc.start()
+    result = load(text)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, size, elapsed
+
+
+def dict_lookups(routes):
+    # What the handlers read per message before PairConfig: int() on the chat ids and .get() with defaults
+    batches = {}
+    for mapping, pair in routes:
+        if mapping.get('active'):
+            batches[int(mapping['source']), int(mapping['destination']), mapping.get('drop_author', True)] = pair
+            if mapping.get('dedup', 'off') == 'off':
+                pair['forwarded'] += 1
+    return batches
+
+
+def object_lookups(routes):
+    batches = {}
+    for mapping, pair in routes:
+        if mapping.active:
+            batches[mapping.source_id, mapping.destination_id, mapping.drop_author] = pair
+            if mapping.dedup == 'off':
+                pair['forwarded'] += 1
+    return batches
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pairs", type=int, default=10000)
+    parser.add_argument("--sources", type=int, default=2000, help="distinct source chats the pairs share")
+    parser.add_argument("--filtered", type=float, default=0.2, help="fraction of pairs with filter lists")
+    parser.add_argument("--lookups", type=int, default=1000000, help="simulated messages per timing run")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per measurement, best is reported")
+    parser.add_argument("--seed", type=int, default=1234)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    text = make_document(rng, args)
+    (dict_mappings, dict_stats), dict_size, dict_load = measure(load_dicts, text)
+    (object_mappings, object_stats), object_size, object_load = measure(load_objects, text)
+
+    round_trip = {
+        user_id: {pair_name: mapping.to_dict() for pair_name, mapping in pairs.items()}
+        for user_id, pairs in object_mappings.items()
+    }
+    mismatches = sum(
+        round_trip['1'][pair_name] != mapping for pair_name, mapping in dict_mappings['1'].items()
+    )
+
+    names = list(dict_mappings['1'])
+    picks = [rng.choice(names) for _ in range(args.lookups)]
+    dict_routes = [(dict_mappings['1'][name], dict_stats['1'][name]) for name in picks]
+    object_routes = [(object_mappings['1'][name], object_stats['1'][name]) for name in picks]
+    dict_time = timed(dict_lookups, dict_routes, repeat=args.repeat)
+    object_time = timed(object_lookups, object_routes, repeat=args.repeat)
+
+    print(f"{args.pairs} pairs over {args.sources} sources, {args.filtered:.0%} with filter lists, "
+          f"JSON round-trip mismatches: {mismatches}")
+    print(f"{'dicts':>8}: {dict_size / 1024 / 1024:6.2f} MiB, {dict_size / args.pairs:5.0f} B/pair, "
+          f"load {dict_load * 1000:6.1f} ms, {dict_time / args.lookups * 1e9:5.0f} ns/message")
+    print(f"{'objects':>8}: {object_size / 1024 / 1024:6.2f} MiB, {object_size / args.pairs:5.0f} B/pair, "
+          f"load {object_load * 1000:6.1f} ms, {object_time / args.lookups * 1e9:5.0f} ns/message")
+    print(f"memory x{dict_size / object_size:.1f} smaller, lookups x{dict_time / object_time:.1f} faster")
+
+
+if __name__ == "__main__":
+    main()
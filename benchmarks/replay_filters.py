@@ -0,0 +1,79 @@
+"""Replay exported channel messages through a pair's filters without Telegram.
+
+The offline counterpart of /testfilters: loads a pair from channel_mappings.json
+or an /exportpairs document, runs every message through bot.replay_filters and
+prints the same block/modify rates, per-stage timings and slowest messages.
+
+Messages come from a Telegram Desktop chat export (result.json) or a plain text
+file with one message per line.
+
+Usage: python benchmarks/replay_filters.py <pair> <messages file> [--pairs channel_mappings.json]
+"""
+import argparse
+import json
+import os
+import sys
+
+from _common import START_DIR, import_bot
+
+bot = import_bot("replay_filters")
+
+
+def load_pair(path, pair_name, user_id=None):
+    with open(path, "rb") as f:
+        data = f.read()
+    try:
+        document = json.loads(data.decode("utf-8-sig"))
+    except ValueError:
+        document = None
+    # channel_mappings.json is keyed by user id, then pair name
+    if isinstance(document, dict) and all(isinstance(pairs, dict) for pairs in document.values()):
+        users = [user_id] if user_id else list(document)
+        for user in users:
+            mapping = document.get(user, {}).get(pair_name)
+            if isinstance(mapping, dict) and 'source' in mapping:
+                return bot.PairConfig(**{'destination': '', **mapping})
+    pairs, problems = bot.validate_pairs(bot.parse_pairs_document(data, path))
+    if problems:
+        sys.exit("\n".join(problems))
+    if pair_name not in pairs:
+        sys.exit(f"pair '{pair_name}' not found in {path}")
+    return pairs[pair_name]
+
+
+def export_text(text):
+    # Desktop exports split formatted text into a list of strings and entity objects
+    if isinstance(text, list):
+        return "".join(part if isinstance(part, str) else part.get("text", "") for part in text)
+    return text or ""
+
+
+def load_messages(path):
+    with open(path, encoding="utf-8-sig") as f:
+        if path.lower().endswith(".json"):
+            export = json.load(f)
+            return [
+                (message.get("id"), export_text(message.get("text")),
+                 any(key in message for key in ("photo", "file", "media_type")))
+                for message in export.get("messages", [])
+                if message.get("type", "message") == "message"
+            ]
+        return [(number, line.rstrip("\n"), False) for number, line in enumerate(f, start=1) if line.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("pair", help="pair name")
+    parser.add_argument("messages", help="result.json from a Telegram Desktop export, or one message per line")
+    parser.add_argument("--pairs", default=bot.MAPPINGS_FILE, help="channel_mappings.json or an /exportpairs document")
+    parser.add_argument("--user", help="user id to look the pair up under in channel_mappings.json")
+    parser.add_argument("--slowest", type=int, default=5, help="slowest messages to list")
+    args = parser.parse_args()
+
+    mapping = load_pair(os.path.join(START_DIR, args.pairs), args.pair, args.user)
+    messages = load_messages(os.path.join(START_DIR, args.messages))
+    print(bot.render_filter_report(args.pair, bot.replay_filters(mapping, messages, args.slowest)))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,71 +1,1736 @@
 import asyncio
+import atexit
+import bisect
+import contextlib
+import contextvars
+import csv
+import functools
+import heapq
+import hashlib
+import io
+import itertools
 import logging
 import json
+import os
+import queue
+import random
+import re
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
 from telethon import TelegramClient, events, errors
+from telethon.network import ConnectionTcpFull
 from telethon.tl.types import MessageMediaWebPage
-from collections import deque
+from collections import Counter, OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait as wait_futures
+from array import array
+from dataclasses import dataclass
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from datetime import datetime
 
 API_ID = 28451755  # Replace with your API ID
 API_HASH = "c888900d408dcd71e8bf31f5aa15ae0e"  # Replace with your API hash
-SESSION_FILE = "userbot_session"
-client = TelegramClient(SESSION_FILE, API_ID, API_HASH)
+# Supervisor mode (python bot.py --supervisor) runs one worker process per session and spreads the
+# sources across them; the first session also handles commands. Every account must be able to
+# read all sources and post to all destinations.
+WORKER_SESSIONS = []
+WORKER_SESSION = os.environ.get("FORWARD_WORKER_SESSION")  # set by the supervisor for each worker
+IS_PRIMARY = not WORKER_SESSION or WORKER_SESSIONS[:1] == [WORKER_SESSION]
+SESSION_FILE = WORKER_SESSION or "userbot_session"
+
+class SignallingConnection(ConnectionTcpFull):
+    # Reports each connect and drop as it happens instead of waiting to be polled
+    def is_main(self):
+        # Exported senders for other data centers use this class too; only the client's own sender counts.
+        # The sender keeps its connection object across reconnects and sets it before the first connect
+        sender = getattr(client, '_sender', None)
+        return getattr(sender, '_connection', None) is self
+
+    async def connect(self, timeout=None, ssl=None):
+        await super().connect(timeout=timeout, ssl=ssl)
+        if self.is_main():
+            set_connected(True)
+
+    async def disconnect(self):
+        if self.is_main():
+            set_connected(False)
+        await super().disconnect()
+
+client = TelegramClient(SESSION_FILE, API_ID, API_HASH, connection=SignallingConnection)
 
 # Configuration
 MAPPINGS_FILE = "channel_mappings.json"
+SAVE_DEBOUNCE = 1.0  # seconds to coalesce config changes into one write
 MAX_RETRIES = 3
 RETRY_DELAY = 5  # seconds
-MAX_QUEUE_SIZE = 100
-MAX_MAPPING_HISTORY = 1000
+SEND_RATE_PER_DESTINATION = 1.0  # sends per second
+SEND_BURST_PER_DESTINATION = 5
+GLOBAL_SEND_RATE = 15.0  # sends per second across all destinations
+GLOBAL_SEND_BURST = 30
+SEND_RATE_MIN = 0.05
+SEND_RATE_RECOVERY = 0.05  # added back to a throttled lane's rate per successful send
+LANE_QUEUE_LIMIT = 1000  # jobs waiting per destination lane before LANE_OVERFLOW_POLICY applies
+LANE_OVERFLOW_POLICY = 'spill'  # 'spill' new messages to the retry queue, or 'drop_oldest' (counted per pair)
+# Lane priority classes; commands are answered by the router directly and never wait in a lane
+PRIORITY_EDIT = 0  # edits and deletes of already forwarded messages
+PRIORITY_NEW = 1
+ALBUM_WINDOW = 1.0  # seconds to wait for the remaining parts of an album
+FORWARD_COALESCE_WINDOW = 0.5  # seconds to collect mirror-pair messages into one forward call
+FORWARD_BATCH_LIMIT = 100
+RESTRICTED_RECHECK = 3600  # seconds before a source with forwarding restricted is tried server-side again
+CATCHUP_MAX_MESSAGES = 1000  # per source; older parts of a longer gap are skipped
+CATCHUP_CONCURRENCY = 4
+PEER_RESOLVE_CONCURRENCY = 8
+SHARD_SYNC_INTERVAL = 2  # seconds between workers publishing stats and checking for config changes
+SHARD_VNODES = 64  # ring points per session
+BACKFILL_MAX_MESSAGES = 1000
+TRIE_MAX_DEPTH = 100  # nested groups in a blacklist/sentence regex before a subtree is flattened
+FILTER_TEST_MAX_MESSAGES = 5000
+RECENT_MESSAGES_SIZE = 20000
+EDIT_DEBOUNCE = 2.0  # seconds; only the latest version of a message edited within this window is applied
+DELETE_BATCH_WINDOW = 0.5  # seconds to collect deletes for one destination
+DELETE_CHUNK_SIZE = 100
+STATE_DB_FILE = "forward_state.db"
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9464  # set to None to disable the Prometheus endpoint
+LOG_FILE = f"forward_bot.{WORKER_SESSION}.log" if WORKER_SESSION else "forward_bot.log"
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+LOG_JSON = True  # JSON lines in LOG_FILE; the console keeps LOG_FORMAT
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+LOG_SAMPLE_BURST = 20  # per-message info lines logged in full each second
+LOG_SAMPLE_EVERY = 50  # past the burst, one in this many is logged
+TRACE_ENABLED = False  # per-stage timing of every forward; also toggled with /trace on|off
+TRACE_SLOW_THRESHOLD = 2.0  # seconds; slower messages are logged with their stage breakdown
+TRACE_SAMPLE_RATE = 0.01
+TRACE_BUFFER_SIZE = 200
+MESSAGE_LENGTH_LIMIT = 4096  # characters Telegram accepts in one message
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+MAX_QUEUE_ATTEMPTS = 8
+RETRY_BACKOFF_MAX = 3600  # seconds
+RETRY_POLL_INTERVAL = 30  # seconds
+QUEUE_DRAIN_CONCURRENCY = 8
+QUEUE_FETCH_BATCH = 100
+MAPPING_CACHE_SIZE = 10000
+MAPPING_FLUSH_INTERVAL = 2  # seconds
+MAPPING_QUERY_CHUNK = 500  # ids per IN (...) query, below SQLite's bound parameter limit
+MAPPING_FLUSH_BATCH = 500
+MAPPING_TTL = 30 * 24 * 3600  # seconds
+MAPPING_COMPACT_INTERVAL = 3600  # seconds
+DEDUP_CACHE_SIZE = 50000  # content hashes kept across all destinations
+DEDUP_TTL = 24 * 3600  # seconds a delivered post counts as a duplicate
+DEDUP_PERSIST = True  # keep content hashes in the state database across restarts
+IMPORT_MAX_BYTES = 5 * 1024 * 1024
 MONITOR_CHAT_ID = None
+URL_PATTERN = re.compile(r'https?://(?:[-\w.]|(?:%[\da-fA-F]{2}))+(?:/[^\s]*)?')
+MENTION_PATTERN = re.compile(r'@[a-zA-Z0-9_]+|\[([^\]]+)\]\(tg://user\?id=\d+\)')
+WHITESPACE_PATTERN = re.compile(r'\s+')
 
 # Logging setup
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("forward_bot.log"),
-        logging.StreamHandler()
-    ]
-)
+class JsonLogFormatter(logging.Formatter):
+    fields = ('user', 'pair', 'source', 'destination', 'message_id', 'suppressed')
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        for field in self.fields:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        return json.dumps(entry, ensure_ascii=False)
+
+class LogSampler(logging.Filter):
+    # Lets the first `burst` info records of each second through, then one in `every`; warnings always pass
+    def __init__(self, burst=LOG_SAMPLE_BURST, every=LOG_SAMPLE_EVERY):
+        super().__init__()
+        self.burst = burst
+        self.every = every
+        self.window = 0
+        self.count = 0
+        self.suppressed = 0
+
+    def filter(self, record):
+        if record.levelno > logging.INFO:
+            return True
+        window = int(time.monotonic())
+        if window != self.window:
+            self.window = window
+            self.count = 0
+        self.count += 1
+        if self.count <= self.burst or self.count % self.every == 0:
+            if self.suppressed:
+                record.suppressed = self.suppressed
+                self.suppressed = 0
+            return True
+        self.suppressed += 1
+        return False
+
+def setup_logging():
+    # Handlers run on a listener thread so file writes never block the event loop
+    file_handler = RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8')
+    file_handler.setFormatter(JsonLogFormatter() if LOG_JSON else logging.Formatter(LOG_FORMAT))
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    queue_handler = QueueHandler(log_queue)
+    queue_handler.setFormatter(logging.Formatter('%(message)s'))
+    logging.basicConfig(level=logging.INFO, handlers=[queue_handler])
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+def log_fields(user=None, pair=None, source=None, destination=None, message_id=None):
+    return {'user': user, 'pair': pair, 'source': source, 'destination': destination, 'message_id': message_id}
+
+log_listener = setup_logging()
 logger = logging.getLogger("ForwardBot")
+# Per-message lines, sampled under load
+message_log = logging.getLogger("ForwardBot.messages")
+message_log.addFilter(LogSampler())
 
 # Data structures
 channel_mappings = {}
-message_queue = deque(maxlen=MAX_QUEUE_SIZE)
-is_connected = False
+state_writer = None
+# Raw entries of pairs that failed to load, written back untouched so a bad pair is never lost
+skipped_pairs = {}
+# Set when channel_mappings.json could not be read; saving would overwrite it with what is in memory
+mappings_load_failed = False
+retry_queue = None
+message_store = None
+content_hashes = None
+source_progress = None
+shard_state = None
+catch_up_lock = asyncio.Lock()
+queue_drain_lock = asyncio.Lock()
+# Set while Telegram is reachable; send lanes wait on it instead of failing
+connected = asyncio.Event()
+# False until main() has finished logging in, so the first connect does not start recovery early
+startup_done = False
 pair_stats = {}
+mappings_dirty = False
+mappings_save_task = None
+# Writes can overlap (the debounced executor write and the shutdown flush); each carries the generation of its snapshot
+mappings_generation = itertools.count(1)
+mappings_written = 0
+mappings_write_lock = threading.Lock()
+# Routing index: source chat id -> tuple of (user_id, pair_name, mapping) for active pairs
+source_routes = {}
+route_sources = {}
+# Input peers resolved once per chat id, and the chats that could not be resolved: chat id -> error
+peer_cache = {}
+unresolved_peers = {}
+# Compiled transform pipelines keyed by (user_id, pair_name), dropped when the pair's config changes
+pair_pipelines = {}
+# Blacklist/blocked-sentence matchers, only rebuilt when those lists change
+pair_matchers = {}
+# Album parts waiting for ALBUM_WINDOW: (chat_id, grouped_id) -> (messages, timer handle)
+pending_albums = {}
+# Mirror-pair messages waiting to be forwarded: (source, destination, drop_author) -> (entries, timer handle)
+pending_forwards = {}
+# Sources that refused a server-side forward: chat id -> monotonic time it was seen; they are copied meanwhile
+restricted_sources = {}
+# Latest edited version per source message: (chat_id, message_id) -> (message, timer handle)
+pending_edits = {}
+# Destination message ids waiting to be deleted: destination -> (message ids, timer handle)
+pending_deletes = {}
+# When each recent live message arrived, for the end-to-end latency: (chat_id, message_id) -> monotonic time
+live_arrivals = OrderedDict()
+
+def parse_chat_id(chat):
+    try:
+        return int(chat)
+    except (TypeError, ValueError):
+        return None
 
-def save_mappings():
+class PairConfig:
+    # One forwarding pair. Chat ids are parsed once and the filter lists frozen into tuples; item
+    # access by field name (mapping['blacklist']) normalises values and keeps the JSON file layout
+    DEFAULTS = {
+        'active': True,
+        'remove_mentions': False,
+        'blacklist': (),
+        'block_urls': False,
+        'header_pattern': '',
+        'footer_pattern': '',
+        'custom_header': '',
+        'custom_footer': '',
+        'blocked_sentences': (),
+        'drop_author': True,
+        'dedup': 'off'
+    }
+    FIELDS = ('source', 'destination') + tuple(DEFAULTS)
+    __slots__ = FIELDS + ('source_id', 'destination_id')
+
+    def __init__(self, source, destination, **fields):
+        # Unknown keys are ignored so files written by newer versions still load
+        self['source'] = source
+        self['destination'] = destination
+        for field, default in self.DEFAULTS.items():
+            self[field] = fields.get(field, default)
+
+    def __getitem__(self, field):
+        if field not in self.FIELDS:
+            raise KeyError(field)
+        return getattr(self, field)
+
+    def __setitem__(self, field, value):
+        if field in ('source', 'destination'):
+            value = str(value)
+            setattr(self, f"{field}_id", parse_chat_id(value))
+        elif field == 'blacklist':
+            value = tuple(sorted(set(value)))
+        elif field == 'blocked_sentences':
+            value = tuple(value)
+        elif field not in self.DEFAULTS:
+            raise KeyError(field)
+        setattr(self, field, value)
+
+    def __contains__(self, field):
+        return field in self.FIELDS
+
+    def get(self, field, default=None):
+        return getattr(self, field) if field in self.FIELDS else default
+
+    def to_dict(self):
+        data = {field: getattr(self, field) for field in self.FIELDS}
+        data['blacklist'] = list(self.blacklist)
+        data['blocked_sentences'] = list(self.blocked_sentences)
+        return data
+
+    def __repr__(self):
+        return f"PairConfig({self.source} → {self.destination})"
+
+class PairStats:
+    # The counters of a pair packed into one array instead of a dict of ints
+    COUNTERS = ('forwarded', 'edited', 'blocked', 'queued', 'duplicates', 'dropped')
+    INDEX = {counter: index for index, counter in enumerate(COUNTERS)}
+    __slots__ = ('counts', 'last_activity')
+
+    def __init__(self, last_activity=None, **counts):
+        self.counts = array('q', [int(counts.get(counter, 0)) for counter in self.COUNTERS])
+        self.last_activity = last_activity
+
+    def __getitem__(self, key):
+        if key == 'last_activity':
+            return self.last_activity
+        return self.counts[self.INDEX[key]]
+
+    def __setitem__(self, key, value):
+        if key == 'last_activity':
+            self.last_activity = value
+        else:
+            self.counts[self.INDEX[key]] = value
+
+    def to_dict(self):
+        return {**dict(zip(self.COUNTERS, self.counts)), 'last_activity': self.last_activity}
+
+def ring_hash(value):
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), 'big')
+
+class HashRing:
+    # Consistent hashing of source chats onto sessions; adding a session only moves the sources it takes over
+    def __init__(self, nodes, vnodes=SHARD_VNODES):
+        points = sorted((ring_hash(f"{node}#{i}"), node) for node in nodes for i in range(vnodes))
+        self.hashes = [point for point, _ in points]
+        self.nodes = [node for _, node in points]
+
+    def owner(self, key):
+        return self.nodes[bisect.bisect(self.hashes, ring_hash(str(key))) % len(self.hashes)]
+
+shard_ring = HashRing(WORKER_SESSIONS) if WORKER_SESSION else None
+
+def owns_source(source_id):
+    return shard_ring is None or shard_ring.owner(source_id) == WORKER_SESSION
+
+def owns_pair(user_id, pair_name):
+    mapping = channel_mappings.get(user_id, {}).get(pair_name)
+    if mapping is None:
+        return IS_PRIMARY
+    if mapping.source_id is None:
+        return IS_PRIMARY
+    return owns_source(mapping.source_id)
+
+def unindex_pair(user_id, pair_name):
+    source_id = route_sources.pop((user_id, pair_name), None)
+    if source_id is None:
+        return
+    routes = tuple(route for route in source_routes.get(source_id, ()) if route[:2] != (user_id, pair_name))
+    if routes:
+        source_routes[source_id] = routes
+    else:
+        source_routes.pop(source_id, None)
+
+def index_pair(user_id, pair_name):
+    unindex_pair(user_id, pair_name)
+    mapping = channel_mappings.get(user_id, {}).get(pair_name)
+    if not mapping or not mapping.active:
+        return
+    source_id = mapping.source_id
+    if source_id is None or mapping.destination_id is None:
+        logger.error(f"Pair '{pair_name}' has an invalid source or destination, not routing it")
+        return
+    if not owns_source(source_id):
+        return
+    # Copy-on-write so handlers iterating the old tuple are not affected
+    source_routes[source_id] = source_routes.get(source_id, ()) + ((user_id, pair_name, mapping),)
+    route_sources[(user_id, pair_name)] = source_id
+
+def rebuild_routes():
+    source_routes.clear()
+    route_sources.clear()
+    for user_id, pairs in channel_mappings.items():
+        for pair_name in pairs:
+            index_pair(user_id, pair_name)
+    shard = f" (worker {WORKER_SESSION})" if WORKER_SESSION else ""
+    logger.info(f"Routing index built: {len(route_sources)} active pairs over {len(source_routes)} sources{shard}")
+
+def peer(chat_id):
+    # The cached input peer saves Telethon a lookup; unknown chats fall back to the plain id
+    return peer_cache.get(chat_id, chat_id)
+
+async def resolve_peer(chat, semaphore=None):
+    try:
+        chat_id = int(chat)
+    except ValueError:
+        unresolved_peers[chat] = "not a numeric chat id"
+        return False
+    async with semaphore or contextlib.nullcontext():
+        try:
+            peer_cache[chat_id] = await client.get_input_entity(chat_id)
+        except (ValueError, errors.RPCError) as e:
+            unresolved_peers[chat_id] = str(e) or type(e).__name__
+            return False
+    unresolved_peers.pop(chat_id, None)
+    return True
+
+def is_unresolved(chat):
+    try:
+        return int(chat) in unresolved_peers
+    except ValueError:
+        return True
+
+def unresolved_pairs():
+    for user_id, pairs in channel_mappings.items():
+        for pair_name, mapping in pairs.items():
+            missing = [f"{role} {mapping[role]}" for role in ('source', 'destination') if is_unresolved(mapping[role])]
+            if missing:
+                yield user_id, pair_name, missing
+
+def pair_chats():
+    return {
+        mapping[role] for pairs in channel_mappings.values() for mapping in pairs.values()
+        for role in ('source', 'destination')
+    }
+
+async def warm_peer_cache():
+    chats = pair_chats()
+    semaphore = asyncio.Semaphore(PEER_RESOLVE_CONCURRENCY)
+    await asyncio.gather(*(resolve_peer(chat, semaphore) for chat in chats))
+    if unresolved_peers:
+        # Chats missing from the session's entity cache can be resolved once the dialogs are loaded
+        try:
+            await client.get_dialogs()
+        except (errors.RPCError, ConnectionError) as e:
+            logger.warning(f"Could not load dialogs to resolve chats: {e}")
+        await asyncio.gather(*(resolve_peer(chat, semaphore) for chat in list(unresolved_peers)))
+    logger.info(f"Resolved {len(chats) - len(unresolved_peers)} of {len(chats)} chats")
+    problems = [
+        f"{pair_name}: {', '.join(missing)}" for _, pair_name, missing in unresolved_pairs()
+    ]
+    for problem in problems:
+        logger.warning(f"Unresolvable chat in pair {problem}")
+    if problems and MONITOR_CHAT_ID:
+        try:
+            await client.send_message(MONITOR_CHAT_ID, "⚠️ Unresolvable chats, these pairs will fail:\n" + "\n".join(problems))
+        except Exception as e:
+            logger.error(f"Error reporting unresolvable chats: {e}")
+
+def write_mappings_file(data, generation):
+    # Write to a temp file of its own and rename over the old one so a crash never leaves a partial file;
+    # a snapshot older than the one already on disk is dropped
+    global mappings_written
+    directory = os.path.dirname(os.path.abspath(MAPPINGS_FILE))
+    with mappings_write_lock:
+        if generation < mappings_written:
+            return
+        fd, temp_file = tempfile.mkstemp(dir=directory, prefix=f"{os.path.basename(MAPPINGS_FILE)}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_file, MAPPINGS_FILE)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.unlink(temp_file)
+            raise
+        mappings_written = generation
+        if os.name == "posix":
+            dir_fd = os.open(directory, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+
+def mappings_document():
+    document = {user_id: dict(pairs) for user_id, pairs in skipped_pairs.items()}
+    for user_id, pairs in channel_mappings.items():
+        document.setdefault(user_id, {}).update(
+            (pair_name, mapping.to_dict()) for pair_name, mapping in pairs.items()
+        )
+    return document
+
+def mappings_save_blocked():
+    if mappings_load_failed:
+        logger.warning(f"{MAPPINGS_FILE} could not be loaded, changes are not saved until it is fixed")
+    return mappings_load_failed
+
+def flush_mappings():
+    global mappings_dirty
+    mappings_dirty = False
+    if mappings_save_blocked():
+        return
     try:
-        with open(MAPPINGS_FILE, "w") as f:
-            json.dump(channel_mappings, f)
+        write_mappings_file(json.dumps(mappings_document()), next(mappings_generation))
         logger.info("Channel mappings saved to file.")
     except Exception as e:
         logger.error(f"Error saving mappings: {e}")
 
+async def write_mappings_when_idle():
+    global mappings_dirty
+    loop = asyncio.get_running_loop()
+    while mappings_dirty:
+        await asyncio.sleep(SAVE_DEBOUNCE)
+        mappings_dirty = False
+        data = json.dumps(mappings_document())
+        try:
+            await loop.run_in_executor(None, write_mappings_file, data, next(mappings_generation))
+            logger.info("Channel mappings saved to file.")
+            if shard_state:
+                shard_state.bump_mappings_version()
+        except Exception as e:
+            logger.error(f"Error saving mappings: {e}")
+
+def save_mappings():
+    global mappings_dirty, mappings_save_task
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        flush_mappings()
+        return
+    if mappings_save_blocked():
+        return
+    mappings_dirty = True
+    if mappings_save_task is None or mappings_save_task.done():
+        mappings_save_task = asyncio.create_task(write_mappings_when_idle())
+
+def read_mappings():
+    # Returns (pairs, raw entries of skipped pairs); raises if the file itself cannot be read
+    with open(MAPPINGS_FILE, "r") as f:
+        data = json.load(f)
+    if not isinstance(data, dict) or not all(isinstance(pairs, dict) for pairs in data.values()):
+        raise ValueError("expected an object of user ids to pairs")
+    # One bad pair is skipped on its own instead of dropping every pair in the file
+    loaded, skipped = {}, {}
+    for user_id, pairs in data.items():
+        loaded[user_id] = {}
+        for pair_name, mapping in pairs.items():
+            try:
+                loaded[user_id][pair_name] = PairConfig(**mapping)
+            except Exception as e:
+                skipped.setdefault(user_id, {})[pair_name] = mapping
+                logger.error(f"Skipping pair '{pair_name}' of user {user_id}, kept in the file as is: {e!r}")
+    return loaded, skipped
+
+def install_mappings(loaded, skipped):
+    global channel_mappings, skipped_pairs, mappings_load_failed
+    channel_mappings, skipped_pairs, mappings_load_failed = loaded, skipped, False
+    logger.info(f"Loaded {sum(len(v) for v in channel_mappings.values())} mappings from file.")
+    for user_id, pairs in channel_mappings.items():
+        if user_id not in pair_stats:
+            pair_stats[user_id] = {}
+        for pair_name in pairs:
+            pair_stats[user_id].setdefault(pair_name, PairStats())
+    rebuild_routes()
+
 def load_mappings():
-    global channel_mappings
+    global mappings_load_failed
     try:
-        with open(MAPPINGS_FILE, "r") as f:
-            channel_mappings = json.load(f)
-        logger.info(f"Loaded {sum(len(v) for v in channel_mappings.values())} mappings from file.")
-        for user_id, pairs in channel_mappings.items():
-            if user_id not in pair_stats:
-                pair_stats[user_id] = {}
-            for pair_name in pairs:
-                pair_stats[user_id][pair_name] = {
-                    'forwarded': 0, 'edited': 0, 'blocked': 0, 'queued': 0, 'last_activity': None
-                }
+        install_mappings(*read_mappings())
     except FileNotFoundError:
         logger.info("No existing mappings file found. Starting fresh.")
+        rebuild_routes()
     except Exception as e:
+        mappings_load_failed = True
         logger.error(f"Error loading mappings: {e}")
+        rebuild_routes()
+
+def open_state_db(path=STATE_DB_FILE):
+    db = sqlite3.connect(path)
+    # Workers in supervisor mode share this file
+    db.execute("PRAGMA busy_timeout=5000")
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    return db
+
+def log_write_error(future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.error(f"Error writing state: {future.exception()}")
+
+class StateWriter:
+    # Every write to the state database runs on one thread with a connection of its own, in the order it was
+    # submitted. When another worker holds the file's lock, busy_timeout stalls that thread instead of the
+    # event loop; reads stay on the loop's connection, which WAL does not block
+    def __init__(self, path):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="state-writer")
+        self.db = self.executor.submit(open_state_db, path).result()
+
+    def _run(self, write):
+        with self.db:
+            return write(self.db)
+
+    def submit(self, write):
+        # write(db) runs in one transaction; await the returned future when a later read depends on it
+        try:
+            future = asyncio.get_running_loop().run_in_executor(self.executor, self._run, write)
+        except RuntimeError:
+            # The loop has stopped (shutdown), so waiting here blocks nothing
+            future = self.executor.submit(self._run, write)
+            wait_futures([future])
+        future.add_done_callback(log_write_error)
+        return future
+
+    def execute(self, sql, params=()):
+        return self.submit(lambda db: db.execute(sql, params).rowcount)
+
+    def executemany(self, sql, rows):
+        return self.submit(lambda db: db.executemany(sql, rows).rowcount)
+
+    def close(self):
+        # Waits for the writes still queued
+        self.executor.submit(self.db.close)
+        self.executor.shutdown(wait=True)
+
+QueueEntry = namedtuple('QueueEntry', 'id user_id pair_name source_chat message_id attempts next_attempt')
+
+class RetryQueue:
+    def __init__(self, db, writer):
+        self.db = db
+        self.writer = writer
+        db.executescript("""
+            CREATE TABLE IF NOT EXISTS retry_queue (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT NOT NULL,
+                pair_name TEXT NOT NULL,
+                source_chat INTEGER NOT NULL,
+                message_id INTEGER NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS retry_queue_pair ON retry_queue (user_id, pair_name, id);
+            CREATE TABLE IF NOT EXISTS dead_letters (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT NOT NULL,
+                pair_name TEXT NOT NULL,
+                source_chat INTEGER NOT NULL,
+                message_id INTEGER NOT NULL,
+                attempts INTEGER NOT NULL,
+                failed_at REAL NOT NULL,
+                error TEXT
+            );
+        """)
+        db.commit()
+
+    def push(self, user_id, pair_name, source_chat, message_id):
+        return self.writer.execute(
+            "INSERT INTO retry_queue (user_id, pair_name, source_chat, message_id, attempts, next_attempt) "
+            "VALUES (?, ?, ?, ?, 0, ?)",
+            (user_id, pair_name, source_chat, message_id, time.time() + RETRY_DELAY)
+        )
+
+    def depth(self):
+        return self.db.execute("SELECT COUNT(*) FROM retry_queue").fetchone()[0]
+
+    def pair_depths(self):
+        rows = self.db.execute("SELECT user_id, pair_name, COUNT(*) FROM retry_queue GROUP BY user_id, pair_name")
+        return {(user_id, pair_name): count for user_id, pair_name, count in rows}
+
+    def dead_letter_count(self):
+        return self.db.execute("SELECT COUNT(*) FROM dead_letters").fetchone()[0]
+
+    def due_pairs(self, now):
+        # A pair is due when the oldest entry at the head of its FIFO is due
+        rows = self.db.execute(
+            "SELECT q.user_id, q.pair_name FROM retry_queue q "
+            "JOIN (SELECT MIN(id) AS head FROM retry_queue GROUP BY user_id, pair_name) h ON q.id = h.head "
+            "WHERE q.next_attempt <= ?",
+            (now,)
+        )
+        return rows.fetchall()
+
+    def pair_entries(self, user_id, pair_name, limit):
+        rows = self.db.execute(
+            "SELECT id, user_id, pair_name, source_chat, message_id, attempts, next_attempt FROM retry_queue "
+            "WHERE user_id = ? AND pair_name = ? ORDER BY id LIMIT ?",
+            (user_id, pair_name, limit)
+        )
+        return [QueueEntry(*row) for row in rows]
+
+    def remove(self, entry):
+        return self.writer.execute("DELETE FROM retry_queue WHERE id = ?", (entry.id,))
+
+    def reschedule(self, entry, error):
+        attempts = entry.attempts + 1
+        if attempts >= MAX_QUEUE_ATTEMPTS:
+            return self.dead_letter(entry, error, attempts)
+        delay = min(RETRY_DELAY * 2 ** attempts, RETRY_BACKOFF_MAX)
+        return self.writer.execute(
+            "UPDATE retry_queue SET attempts = ?, next_attempt = ? WHERE id = ?",
+            (attempts, time.time() + delay, entry.id)
+        )
+
+    def dead_letter(self, entry, error, attempts=None):
+        def move(db):
+            db.execute(
+                "INSERT INTO dead_letters (user_id, pair_name, source_chat, message_id, attempts, failed_at, error) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (entry.user_id, entry.pair_name, entry.source_chat, entry.message_id,
+                 entry.attempts if attempts is None else attempts, time.time(), error)
+            )
+            db.execute("DELETE FROM retry_queue WHERE id = ?", (entry.id,))
+        future = self.writer.submit(move)
+        logger.error(f"Message {entry.message_id} from {entry.source_chat} moved to dead letters for pair '{entry.pair_name}': {error}")
+        return future
+
+class MessageMapStore:
+    # Source -> destination message ids, with an LRU cache and batched write-behind
+    def __init__(self, db, writer, cache_size=MAPPING_CACHE_SIZE):
+        self.db = db
+        self.writer = writer
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.pending = {}
+        # Flushed batches the writer has not committed yet; lookups still see them
+        self.saving = deque()
+        self.pending_rows = 0
+        self.hits = 0
+        self.misses = 0
+        db.executescript("""
+            CREATE TABLE IF NOT EXISTS message_map (
+                source_chat INTEGER NOT NULL,
+                source_msg INTEGER NOT NULL,
+                destination INTEGER NOT NULL,
+                dest_msg INTEGER NOT NULL,
+                created REAL NOT NULL,
+                PRIMARY KEY (source_chat, source_msg, destination)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS message_map_created ON message_map (created);
+        """)
+        db.commit()
+
+    def _destinations(self, key):
+        destinations = self.cache.get(key)
+        if destinations is not None:
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return destinations
+        self.misses += 1
+        rows = self.db.execute(
+            "SELECT destination, dest_msg FROM message_map WHERE source_chat = ? AND source_msg = ?", key
+        )
+        destinations = dict(rows.fetchall())
+        for batch in self.unsaved():
+            destinations.update(batch.get(key, {}))
+        self.cache[key] = destinations
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return destinations
+
+    def get(self, source_chat, source_msg, destination):
+        return self._destinations((source_chat, source_msg)).get(destination)
+
+    def find_many(self, source_chats, source_msgs):
+        # Bulk lookup for deletions: one query per chunk that bypasses the cache, so misses do not evict live entries
+        source_chats, source_msgs = list(source_chats), list(source_msgs)
+        found = {}
+        for start in range(0, len(source_msgs), MAPPING_QUERY_CHUNK):
+            chunk = source_msgs[start:start + MAPPING_QUERY_CHUNK]
+            rows = self.db.execute(
+                f"SELECT source_chat, source_msg, destination, dest_msg FROM message_map "
+                f"WHERE source_chat IN ({','.join('?' * len(source_chats))}) AND source_msg IN ({','.join('?' * len(chunk))})",
+                source_chats + chunk
+            )
+            for source_chat, source_msg, destination, dest_msg in rows:
+                found.setdefault((source_chat, source_msg), {})[destination] = dest_msg
+        wanted_chats, wanted_msgs = set(source_chats), set(source_msgs)
+        for batch in self.unsaved():
+            for key, destinations in batch.items():
+                if key[0] in wanted_chats and key[1] in wanted_msgs:
+                    found.setdefault(key, {}).update(destinations)
+        return found
+
+    def unsaved(self):
+        # Oldest first, so newer rows win when merged
+        return [*self.saving, self.pending]
+
+    def add(self, source_chat, source_msg, destination, dest_msg):
+        key = (source_chat, source_msg)
+        # A new message is rarely looked up before the next flush; a miss merges pending anyway
+        cached = self.cache.get(key)
+        if cached is not None:
+            cached[destination] = dest_msg
+        self.pending.setdefault(key, {})[destination] = dest_msg
+        self.pending_rows += 1
+        if self.pending_rows >= MAPPING_FLUSH_BATCH:
+            self.flush()
+
+    def discard(self, source_chat, source_msg, destination=None):
+        self.discard_many(source_chat, [source_msg], destination)
+
+    def discard_many(self, source_chat, source_msgs, destination=None):
+        for source_msg in source_msgs:
+            key = (source_chat, source_msg)
+            for entries in (self.cache.get(key), *(batch.get(key) for batch in self.unsaved())):
+                if entries is None:
+                    continue
+                if destination is None:
+                    entries.clear()
+                else:
+                    entries.pop(destination, None)
+        # Queued behind any flush of the same rows, so the delete always lands last
+        if destination is None:
+            self.writer.executemany(
+                "DELETE FROM message_map WHERE source_chat = ? AND source_msg = ?",
+                [(source_chat, source_msg) for source_msg in source_msgs]
+            )
+        else:
+            self.writer.executemany(
+                "DELETE FROM message_map WHERE source_chat = ? AND source_msg = ? AND destination = ?",
+                [(source_chat, source_msg, destination) for source_msg in source_msgs]
+            )
+
+    def flush(self):
+        if not self.pending:
+            return
+        now = time.time()
+        rows = [
+            (source_chat, source_msg, destination, dest_msg, now)
+            for (source_chat, source_msg), destinations in self.pending.items()
+            for destination, dest_msg in destinations.items()
+        ]
+        self.saving.append(self.pending)
+        self.pending = {}
+        self.pending_rows = 0
+        future = self.writer.executemany("INSERT OR REPLACE INTO message_map VALUES (?, ?, ?, ?, ?)", rows)
+        # The writer commits in order, so the oldest batch is always the one that finished
+        future.add_done_callback(lambda _: self.saving.popleft())
+
+    async def compact(self, ttl=MAPPING_TTL):
+        removed = await self.writer.execute("DELETE FROM message_map WHERE created < ?", (time.time() - ttl,))
+        if removed:
+            logger.info(f"Compacted {removed} expired message mappings")
+
+class ContentHashCache:
+    # Digests of content recently delivered to each destination, bounded by size and age
+    def __init__(self, db=None, writer=None, size=DEDUP_CACHE_SIZE, ttl=DEDUP_TTL, shared=False):
+        self.db = db
+        self.writer = writer
+        # In supervisor mode the workers feeding one destination check and record in the table itself
+        self.shared = shared and db is not None
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.pending = {}
+        if db is None:
+            return
+        db.executescript("""
+            CREATE TABLE IF NOT EXISTS content_hashes (
+                destination INTEGER NOT NULL,
+                digest BLOB NOT NULL,
+                seen REAL NOT NULL,
+                PRIMARY KEY (destination, digest)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS content_hashes_seen ON content_hashes (seen);
+        """)
+        db.commit()
+        rows = db.execute(
+            "SELECT destination, digest, seen FROM content_hashes WHERE seen >= ? ORDER BY seen DESC LIMIT ?",
+            (time.time() - ttl, size)
+        ).fetchall()
+        for destination, digest, seen in reversed(rows):
+            self.entries[(destination, digest)] = seen
+
+    def seen(self, destination, digest):
+        key = (destination, digest)
+        seen = self.entries.get(key)
+        if seen is None:
+            return False
+        if time.time() - seen > self.ttl:
+            del self.entries[key]
+            return False
+        return True
+
+    def add(self, destination, digest):
+        key = (destination, digest)
+        now = time.time()
+        self.entries[key] = now
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        if self.db is not None:
+            self.pending[key] = now
+
+    async def claim(self, destination, digest):
+        # True when this worker recorded the digest first; the insert is the check, so no other worker can race it
+        now = time.time()
+
+        def insert(db):
+            claimed = db.execute(
+                "INSERT OR IGNORE INTO content_hashes VALUES (?, ?, ?)", (destination, digest, now)
+            ).rowcount
+            if not claimed:
+                claimed = db.execute(
+                    "UPDATE content_hashes SET seen = ? WHERE destination = ? AND digest = ? AND seen < ?",
+                    (now, destination, digest, now - self.ttl)
+                ).rowcount
+            return claimed
+        return bool(await self.writer.submit(insert))
+
+    def release(self, destination, digests):
+        # Gives back the claims of a send that failed, so its retry is not taken for a duplicate
+        digests = [(destination, digest) for digest in digests if digest]
+        if not self.shared or not digests:
+            return
+        self.writer.executemany("DELETE FROM content_hashes WHERE destination = ? AND digest = ?", digests)
+
+    def flush(self):
+        if not self.pending:
+            return
+        rows = [(destination, digest, seen) for (destination, digest), seen in self.pending.items()]
+        self.pending = {}
+        self.writer.executemany("INSERT OR REPLACE INTO content_hashes VALUES (?, ?, ?)", rows)
+
+    def compact(self):
+        if self.db is None:
+            return
+        self.writer.execute("DELETE FROM content_hashes WHERE seen < ?", (time.time() - self.ttl,))
+
+def media_file_id(media):
+    file = getattr(media, 'photo', None) or getattr(media, 'document', None)
+    return getattr(file, 'id', None)
+
+def content_digest(text, media):
+    # Normalized post-filter text plus the media file ids; None when there is nothing to compare
+    media_ids = [str(file_id) for file_id in map(media_file_id, media) if file_id is not None]
+    normalized = WHITESPACE_PATTERN.sub(' ', text or '').strip().lower()
+    if not normalized and not media_ids:
+        return None
+    return hashlib.blake2b(f"{normalized}\0{','.join(media_ids)}".encode(), digest_size=16).digest()
+
+async def check_duplicate(mapping, destination, text, media, user_id, pair_name):
+    # Returns the content digest to remember once delivered, and whether to skip the send
+    mode = mapping.dedup
+    if mode == 'off':
+        return None, False
+    digest = content_digest(text, media)
+    if digest is None:
+        return None, False
+    if content_hashes.shared:
+        if await content_hashes.claim(destination, digest):
+            return digest, False
+        # Someone else holds the claim, so there is nothing of ours to release or record
+        pair_stats[user_id][pair_name]['duplicates'] += 1
+        return None, mode == 'skip'
+    if not content_hashes.seen(destination, digest):
+        return digest, False
+    pair_stats[user_id][pair_name]['duplicates'] += 1
+    return digest, mode == 'skip'
+
+class MessageTrace:
+    __slots__ = ('label', 'started', 'spans')
+
+    def __init__(self, label):
+        self.label = label
+        self.started = time.monotonic()
+        self.spans = []
+
+    @contextlib.contextmanager
+    def span(self, name):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.spans.append((name, time.monotonic() - started))
+
+    def add(self, name, duration):
+        self.spans.append((name, duration))
+
+    def summary(self):
+        total = time.monotonic() - self.started
+        breakdown = ", ".join(f"{name}={duration * 1000:.1f}ms" for name, duration in self.spans)
+        return f"{self.label}: {total * 1000:.1f}ms [{breakdown}]", total
+
+    def finish(self):
+        summary, total = self.summary()
+        slow = total >= TRACE_SLOW_THRESHOLD
+        if slow:
+            logger.warning(f"Slow message {summary}")
+        if slow or random.random() < TRACE_SAMPLE_RATE:
+            trace_buffer.append(f"{datetime.now().strftime('%H:%M:%S')} {summary}")
+
+class NullTrace:
+    # Stands in for a trace while tracing is disabled
+    __slots__ = ()
+
+    def span(self, name):
+        return NULL_SPAN
+
+    def add(self, name, duration):
+        pass
+
+NULL_SPAN = contextlib.nullcontext()
+NULL_TRACE = NullTrace()
+current_trace = contextvars.ContextVar('current_trace', default=NULL_TRACE)
+trace_buffer = deque(maxlen=TRACE_BUFFER_SIZE)
+
+def traced(describe):
+    def decorate(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args):
+            if not TRACE_ENABLED:
+                return await fn(*args)
+            trace = MessageTrace(describe(*args))
+            token = current_trace.set(trace)
+            try:
+                return await fn(*args)
+            finally:
+                current_trace.reset(token)
+                trace.finish()
+        return wrapper
+    return decorate
+
+def trace_span(name):
+    return current_trace.get().span(name)
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-th observation
+        if not self.count:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return float('inf')
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{escape_label(value)}"' for key, value in labels) + "}"
+
+class MetricsRegistry:
+    def __init__(self, prefix="forwardbot"):
+        self.prefix = prefix
+        self.counters = {}
+        self.histograms = {}
+        self.collectors = []
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+
+    def histogram(self, name, **labels):
+        return self.histograms.get((name, tuple(sorted(labels.items()))))
+
+    def counter(self, name, **labels):
+        return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def collector(self, fn):
+        # fn() yields (name, type, labels, value) samples computed at scrape time
+        self.collectors.append(fn)
+        return fn
+
+    def render(self):
+        # Samples arrive grouped by pair or destination, but each family must be one block under its TYPE line
+        families = {}
+
+        def family(name, metric_type):
+            full_name = f"{self.prefix}_{name}"
+            if full_name not in families:
+                families[full_name] = (metric_type, [])
+            return full_name, families[full_name][1]
+
+        for fn in self.collectors:
+            for name, metric_type, labels, value in fn():
+                full_name, lines = family(name, metric_type)
+                lines.append(f"{full_name}{format_labels(tuple(sorted(labels.items())))} {value}")
+        for (name, labels), value in sorted(self.counters.items()):
+            full_name, lines = family(name, "counter")
+            lines.append(f"{full_name}{format_labels(labels)} {value}")
+        for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+            full_name, lines = family(name, "histogram")
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append(f"{full_name}_bucket{format_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{full_name}_bucket{format_labels(labels + (('le', '+Inf'),))} {histogram.count}")
+            lines.append(f"{full_name}_sum{format_labels(labels)} {histogram.total}")
+            lines.append(f"{full_name}_count{format_labels(labels)} {histogram.count}")
+        output = []
+        for full_name, (metric_type, lines) in families.items():
+            output.append(f"# TYPE {full_name} {metric_type}")
+            output.extend(lines)
+        return "\n".join(output) + "\n"
+
+metrics = MetricsRegistry()
+
+@metrics.collector
+def collect_pair_stats():
+    # Each worker exports only the pairs it forwards; the copies the primary pulls in for reports are not exported again
+    for user_id, pairs in pair_stats.items():
+        for pair_name, stats in pairs.items():
+            if not owns_pair(user_id, pair_name):
+                continue
+            for counter in PairStats.COUNTERS:
+                yield f"{counter}_total", "counter", {'user': user_id, 'pair': pair_name}, stats[counter]
+
+@metrics.collector
+def collect_runtime_state():
+    # The queue is shared by every worker, so only the primary reports it
+    if retry_queue and IS_PRIMARY:
+        yield "retry_queue_depth", "gauge", {}, retry_queue.depth()
+        yield "dead_letters", "gauge", {}, retry_queue.dead_letter_count()
+    if message_store:
+        lookups = message_store.hits + message_store.misses
+        yield "mapping_cache_hits_total", "counter", {}, message_store.hits
+        yield "mapping_cache_misses_total", "counter", {}, message_store.misses
+        yield "mapping_cache_hit_ratio", "gauge", {}, message_store.hits / lookups if lookups else 0
+    for destination, lane in send_scheduler.lanes.items():
+        yield "send_lane_depth", "gauge", {'destination': destination}, lane.size
+        yield "send_lane_rate", "gauge", {'destination': destination}, lane.bucket.rate
+
+async def timed_rpc(method, destination, call):
+    started = time.perf_counter()
+    try:
+        return await call
+    finally:
+        elapsed = time.perf_counter() - started
+        metrics.observe('rpc_seconds', elapsed, method=method, destination=destination)
+        current_trace.get().add(f"rpc:{method}", elapsed)
+
+def record_arrival(message):
+    live_arrivals[(message.chat_id, message.id)] = time.monotonic()
+    if len(live_arrivals) > RECENT_MESSAGES_SIZE:
+        live_arrivals.popitem(last=False)
+
+def observe_delivery(message, user_id, pair_name):
+    # End-to-end time from the live event reaching the bot to its copy in the destination; catch-up,
+    # backfill and retried messages were not live and are left out
+    arrived = live_arrivals.get((message.chat_id, message.id))
+    if arrived is not None:
+        metrics.observe('end_to_end_seconds', time.monotonic() - arrived, user=user_id, pair=pair_name)
+
+def run_pipeline(pipeline, text, has_media, user_id, pair_name):
+    started = time.perf_counter()
+    trace = current_trace.get()
+    result = pipeline.run(text, has_media) if trace is NULL_TRACE else pipeline.run_traced(text, has_media, trace)
+    metrics.observe('filter_seconds', time.perf_counter() - started, user=user_id, pair=pair_name)
+    return result
+
+def observe_flood_wait(destination, seconds):
+    current_trace.get().add('flood_wait', seconds)
+    metrics.inc('flood_waits_total', destination=destination)
+    metrics.observe('flood_wait_seconds', seconds, destination=destination)
+
+def format_seconds(value):
+    if value is None:
+        return "N/A"
+    return "> 300s" if value == float('inf') else f"≤ {value}s"
+
+def render_pair_report(user_id, title, detailed=True):
+    report = [title]
+    queued_by_pair = retry_queue.pair_depths() if retry_queue else {}
+    empty_stats = PairStats()
+    for pair_name, data in channel_mappings.get(user_id, {}).items():
+        stats = pair_stats.get(user_id, {}).get(pair_name, empty_stats)
+        latency = metrics.histogram('end_to_end_seconds', user=user_id, pair=pair_name)
+        filtering = metrics.histogram('filter_seconds', user=user_id, pair=pair_name)
+        lines = [
+            f"\n🔹 {pair_name}: {data['source']} → {data['destination']}",
+            f"   Status: {'Active' if data['active'] else 'Paused'}",
+            f"   Forwarded: {stats['forwarded']}",
+            f"   Edited: {stats['edited']}",
+            f"   Blocked: {stats['blocked']}",
+            f"   Queued: {stats['queued']} (waiting: {queued_by_pair.get((user_id, pair_name), 0)})",
+            f"   Pending sends: {send_scheduler.pair_depth(data.destination_id, user_id, pair_name)} "
+            f"(destination lane: {send_scheduler.depth(data.destination_id)}/{LANE_QUEUE_LIMIT})",
+        ]
+        missing = [role for role in ('source', 'destination') if is_unresolved(data[role])]
+        if missing:
+            lines.append(f"   ⚠️ Unresolved: {', '.join(missing)}")
+        if data.get('dedup', 'off') != 'off':
+            lines.append(f"   Duplicates ({data['dedup']}): {stats['duplicates']}")
+        if stats['dropped']:
+            lines.append(f"   Dropped (send lane full): {stats['dropped']}")
+        if detailed:
+            lines.append(
+                f"   Latency p50/p99: {format_seconds(latency and latency.quantile(0.5))} / "
+                f"{format_seconds(latency and latency.quantile(0.99))}"
+            )
+            lines.append(f"   Filter p99: {format_seconds(filtering and filtering.quantile(0.99))}")
+            lines.append(f"   Flood waits: {metrics.counter('flood_waits_total', destination=data.destination_id)}")
+            lines.append(f"   Last Activity: {stats['last_activity'] or 'N/A'}")
+        report.append("\n".join(lines))
+    report.append(f"\n📥 Total Queued Messages: {retry_queue.depth() if retry_queue else 0}")
+    if detailed and message_store:
+        lookups = message_store.hits + message_store.misses
+        hit_rate = f"{message_store.hits / lookups:.0%}" if lookups else "N/A"
+        report.append(f"🗂️ Mapping cache hit rate: {hit_rate}")
+    return "\n".join(report)
+
+async def handle_metrics_request(reader, writer):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            status, body = "200 OK", metrics.render().encode()
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except Exception as e:
+        logger.error(f"Error serving metrics: {e}")
+    finally:
+        writer.close()
+
+async def start_metrics_server():
+    server = await asyncio.start_server(handle_metrics_request, METRICS_HOST, METRICS_PORT)
+    logger.info(f"Metrics available at http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return server
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+LaneJob = namedtuple('LaneJob', 'job args future pairs spill')
+
+class SendLane:
+    def __init__(self, destination):
+        self.destination = destination
+        # One FIFO per priority class, most urgent first
+        self.queues = (deque(), deque())
+        self.size = 0
+        self.pair_depths = Counter()
+        self.ready = asyncio.Event()
+        self.bucket = TokenBucket(SEND_RATE_PER_DESTINATION, SEND_BURST_PER_DESTINATION)
+        self.blocked_until = 0
+        self.worker = None
+
+    def _count(self, item, delta):
+        self.size += delta
+        self.pair_depths.update({pair: delta for pair in item.pairs})
+        if self.size:
+            self.ready.set()
+        else:
+            self.ready.clear()
+
+    def push(self, item, priority):
+        self.queues[priority].append(item)
+        self._count(item, 1)
+
+    def pop(self):
+        for jobs in self.queues:
+            if jobs:
+                item = jobs.popleft()
+                self._count(item, -1)
+                return item
+        return None
+
+    def drop_oldest(self, priority):
+        # Drops the oldest job of the least urgent class, unless that class outranks the incoming job
+        for victim_priority in range(len(self.queues) - 1, priority - 1, -1):
+            if self.queues[victim_priority]:
+                item = self.queues[victim_priority].popleft()
+                self._count(item, -1)
+                return item
+        return None
+
+class SendScheduler:
+    # One ordered lane per destination, each rate limited on its own and by an account-wide bucket
+    def __init__(self):
+        self.lanes = {}
+        self.global_bucket = TokenBucket(GLOBAL_SEND_RATE, GLOBAL_SEND_BURST)
+        # (user_id, pair_name) with jobs spilled to the retry queue; their later jobs follow until it drains
+        self.spilled_pairs = set()
+
+    def lane(self, destination):
+        lane = self.lanes.get(destination)
+        if lane is None:
+            lane = self.lanes[destination] = SendLane(destination)
+        return lane
+
+    def submit(self, destination, job, *args, priority=PRIORITY_NEW, pairs=(), spill=None):
+        lane = self.lane(destination)
+        future = asyncio.get_running_loop().create_future()
+        item = LaneJob(job, args, future, pairs, spill)
+        if spill and not self.spilled_pairs.isdisjoint(pairs):
+            # Overtaking the spilled jobs through the lane would break the pair's order
+            self.spill(item)
+            return future
+        if lane.size >= LANE_QUEUE_LIMIT and not self.make_room(lane, item, priority):
+            return future
+        lane.push(item, priority)
+        if lane.worker is None or lane.worker.done():
+            lane.worker = asyncio.create_task(self._run_lane(lane))
+        return future
+
+    def make_room(self, lane, item, priority):
+        # Applies LANE_OVERFLOW_POLICY to a full lane; False means the incoming job was not queued
+        metrics.inc('send_lane_overflow_total', destination=lane.destination, policy=LANE_OVERFLOW_POLICY)
+        if LANE_OVERFLOW_POLICY == 'spill' and item.spill:
+            self.spill(item)
+            return False
+        if LANE_OVERFLOW_POLICY == 'drop_oldest':
+            dropped = lane.drop_oldest(priority) or item
+            dropped.future.set_result(None)
+            for user_id, pair_name in dropped.pairs:
+                if pair_name in pair_stats.get(user_id, {}):
+                    pair_stats[user_id][pair_name]['dropped'] += 1
+            pair_names = ', '.join(sorted({pair_name for _, pair_name in dropped.pairs})) or 'no pair'
+            message_log.warning(
+                f"Send lane for {lane.destination} is full, dropped a job for {pair_names}",
+                extra=log_fields(destination=lane.destination)
+            )
+            return dropped is not item
+        # Jobs that cannot spill (edits) queue past the limit
+        return True
+
+    def spill(self, item):
+        item.spill()
+        item.future.set_result(None)
+        self.spilled_pairs.update(item.pairs)
+
+    def spill_drained(self, user_id, pair_name):
+        self.spilled_pairs.discard((user_id, pair_name))
+
+    async def _run_lane(self, lane):
+        while True:
+            await lane.ready.wait()
+            job, args, future, _, _ = lane.pop()
+            try:
+                result = await job(*args)
+            except Exception as e:
+                logger.error(f"Error in send lane for {lane.destination}: {e}")
+                result = None
+            if not future.done():
+                future.set_result(result)
+
+    async def acquire(self, destination):
+        lane = self.lane(destination)
+        started = time.monotonic()
+        if not connected.is_set():
+            await connected.wait()
+        while True:
+            wait = lane.blocked_until - time.monotonic()
+            if wait <= 0:
+                break
+            await asyncio.sleep(wait)
+        await lane.bucket.acquire()
+        await self.global_bucket.acquire()
+        current_trace.get().add('rate_limit_wait', time.monotonic() - started)
+
+    def flood_wait(self, destination, seconds):
+        observe_flood_wait(destination, seconds)
+        lane = self.lane(destination)
+        lane.blocked_until = max(lane.blocked_until, time.monotonic() + seconds)
+        lane.bucket.rate = max(SEND_RATE_MIN, lane.bucket.rate / 2)
+
+    def success(self, destination):
+        bucket = self.lane(destination).bucket
+        if bucket.rate < SEND_RATE_PER_DESTINATION:
+            bucket.rate = min(SEND_RATE_PER_DESTINATION, bucket.rate + SEND_RATE_RECOVERY)
+
+    def depth(self, destination=None):
+        if destination is not None:
+            lane = self.lanes.get(destination)
+            return lane.size if lane else 0
+        return sum(lane.size for lane in self.lanes.values())
+
+    def pair_depth(self, destination, user_id, pair_name):
+        lane = self.lanes.get(destination)
+        return lane.pair_depths[(user_id, pair_name)] if lane else 0
+
+send_scheduler = SendScheduler()
+
+class SourceProgress:
+    # Per source, the id up to which every dispatched message has been delivered or queued for retry, plus
+    # the recently dispatched ids used to skip duplicates. A message still in a buffer or send lane holds
+    # the saved position back, so a restart catches it up again instead of losing it
+    def __init__(self, db, writer):
+        self.db = db
+        self.writer = writer
+        db.executescript("""
+            CREATE TABLE IF NOT EXISTS source_progress (
+                source_chat INTEGER PRIMARY KEY,
+                last_message_id INTEGER NOT NULL,
+                updated REAL NOT NULL
+            );
+        """)
+        db.commit()
+        self.last_ids = dict(db.execute("SELECT source_chat, last_message_id FROM source_progress"))
+        self.dirty = set()
+        self.recent = OrderedDict()
+        # (source_chat, message_id) -> jobs still outstanding; a min-heap of held ids per source
+        self.holds = {}
+        self.held_ids = {}
+        self.done_ids = {}
+
+    def get(self, source_chat):
+        return self.last_ids.get(source_chat)
+
+    def seen(self, source_chat, message_id):
+        return (source_chat, message_id) in self.recent
+
+    def start_at(self, source_chat, message_id):
+        # A new source starts from its latest message instead of replaying history
+        self.last_ids[source_chat] = message_id
+        self.dirty.add(source_chat)
+
+    def mark(self, source_chat, message_id):
+        # Called when a message is dispatched; it holds progress until release() is called for it
+        self.recent[(source_chat, message_id)] = None
+        if len(self.recent) > RECENT_MESSAGES_SIZE:
+            self.recent.popitem(last=False)
+        key = (source_chat, message_id)
+        if message_id > self.last_ids.get(source_chat, 0) and key not in self.holds:
+            self.holds[key] = 1
+            heapq.heappush(self.held_ids.setdefault(source_chat, []), message_id)
+
+    def hold(self, keys):
+        # One more job for each message; messages that were never marked (backfill) are not tracked
+        for key in keys:
+            if key in self.holds:
+                self.holds[key] += 1
+
+    def release(self, keys):
+        for key in keys:
+            count = self.holds.get(key)
+            if count is None:
+                continue
+            if count > 1:
+                self.holds[key] = count - 1
+                continue
+            del self.holds[key]
+            source_chat, message_id = key
+            self.done_ids[source_chat] = max(self.done_ids.get(source_chat, 0), message_id)
+            self.advance(source_chat)
+
+    def advance(self, source_chat):
+        held = self.held_ids.get(source_chat)
+        while held and (source_chat, held[0]) not in self.holds:
+            heapq.heappop(held)
+        if held:
+            position = held[0] - 1
+        else:
+            self.held_ids.pop(source_chat, None)
+            position = self.done_ids.pop(source_chat, 0)
+        if position > self.last_ids.get(source_chat, 0):
+            self.last_ids[source_chat] = position
+            self.dirty.add(source_chat)
+
+    def flush(self):
+        if not self.dirty:
+            return
+        now = time.time()
+        rows = [(source_chat, self.last_ids[source_chat], now) for source_chat in self.dirty]
+        self.dirty = set()
+        self.writer.executemany("INSERT OR REPLACE INTO source_progress VALUES (?, ?, ?)", rows)
+
+def message_keys(messages):
+    return [(message.chat_id, message.id) for message in messages]
+
+def track_delivery(future, messages, held=False):
+    # Progress moves past these messages once the lane job has finished, spilled or been dropped
+    keys = message_keys(messages)
+    if not held:
+        source_progress.hold(keys)
+    future.add_done_callback(lambda _: source_progress.release(keys))
+
+def init_state(db_path=STATE_DB_FILE):
+    global state_writer, retry_queue, message_store, source_progress, content_hashes, shard_state
+    db = open_state_db(db_path)
+    state_writer = StateWriter(db_path)
+    retry_queue = RetryQueue(db, state_writer)
+    message_store = MessageMapStore(db, state_writer)
+    source_progress = SourceProgress(db, state_writer)
+    persist_hashes = DEDUP_PERSIST or WORKER_SESSION
+    content_hashes = ContentHashCache(
+        db if persist_hashes else None, state_writer if persist_hashes else None, shared=bool(WORKER_SESSION)
+    )
+    if WORKER_SESSION:
+        shard_state = ShardState(db, state_writer)
+    logger.info(f"Retry queue opened with {retry_queue.depth()} pending messages")
+
+async def run_state_flush():
+    last_compaction = 0
+    while True:
+        await asyncio.sleep(MAPPING_FLUSH_INTERVAL)
+        try:
+            message_store.flush()
+            source_progress.flush()
+            content_hashes.flush()
+            if time.monotonic() - last_compaction >= MAPPING_COMPACT_INTERVAL:
+                await message_store.compact()
+                content_hashes.compact()
+                last_compaction = time.monotonic()
+        except Exception as e:
+            logger.error(f"Error persisting message mappings: {e}")
+
+class ShardState:
+    # What the workers of one supervisor share: each pair's stats, and a version bumped on every config save
+    def __init__(self, db, writer):
+        self.db = db
+        self.writer = writer
+        db.executescript("""
+            CREATE TABLE IF NOT EXISTS shard_stats (
+                user_id TEXT NOT NULL,
+                pair_name TEXT NOT NULL,
+                session TEXT NOT NULL,
+                stats TEXT NOT NULL,
+                updated REAL NOT NULL,
+                PRIMARY KEY (user_id, pair_name)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS shard_config (
+                key TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            );
+        """)
+        db.commit()
+
+    def publish(self, session, stats):
+        now = time.time()
+        return self.writer.executemany(
+            "INSERT OR REPLACE INTO shard_stats VALUES (?, ?, ?, ?, ?)",
+            [(user_id, pair_name, session, json.dumps(pair.to_dict()), now) for user_id, pair_name, pair in stats]
+        )
+
+    def remote_stats(self, session):
+        rows = self.db.execute("SELECT user_id, pair_name, stats FROM shard_stats WHERE session != ?", (session,))
+        return [(user_id, pair_name, PairStats(**json.loads(stats))) for user_id, pair_name, stats in rows]
+
+    def mappings_version(self):
+        row = self.db.execute("SELECT value FROM shard_config WHERE key = 'mappings_version'").fetchone()
+        return row[0] if row else 0
+
+    def bump_mappings_version(self):
+        return self.writer.execute(
+            "INSERT INTO shard_config VALUES ('mappings_version', 1) "
+            "ON CONFLICT (key) DO UPDATE SET value = value + 1"
+        )
+
+async def reload_mappings():
+    # New or edited filter lists are compiled off the loop while the old pairs stay live, then
+    # mappings and matchers are swapped in together; unchanged lists keep their matchers
+    try:
+        loaded, skipped = read_mappings()
+    except Exception as e:
+        logger.error(f"Error reloading mappings: {e}")
+        return
+    matchers, stale = {}, {}
+    for user_id, pairs in loaded.items():
+        for pair_name, mapping in pairs.items():
+            key = (user_id, pair_name)
+            previous = channel_mappings.get(user_id, {}).get(pair_name)
+            if key in pair_matchers and previous is not None and (
+                (previous.blacklist, previous.blocked_sentences) == (mapping.blacklist, mapping.blocked_sentences)
+            ):
+                matchers[key] = pair_matchers[key]
+            elif mapping.blacklist or mapping.blocked_sentences:
+                stale[key] = mapping
+    matchers.update(await build_matchers(stale))
+    install_mappings(loaded, skipped)
+    pair_pipelines.clear()
+    pair_matchers.clear()
+    pair_matchers.update(matchers)
+
+async def run_shard_sync():
+    version = shard_state.mappings_version()
+    while True:
+        await asyncio.sleep(SHARD_SYNC_INTERVAL)
+        try:
+            shard_state.publish(WORKER_SESSION, [
+                (user_id, pair_name, stats)
+                for user_id, pairs in pair_stats.items() for pair_name, stats in pairs.items()
+                if owns_pair(user_id, pair_name)
+            ])
+            if IS_PRIMARY:
+                # Reports and /monitor run here, so pull in the pairs the other workers forward
+                for user_id, pair_name, stats in shard_state.remote_stats(WORKER_SESSION):
+                    if user_id in pair_stats and pair_name in pair_stats[user_id] and not owns_pair(user_id, pair_name):
+                        pair_stats[user_id][pair_name] = stats
+                continue
+            current = shard_state.mappings_version()
+            if current != version:
+                version = current
+                await reload_mappings()
+                missing = [chat for chat in pair_chats() if is_unresolved(chat) or int(chat) not in peer_cache]
+                await asyncio.gather(*(resolve_peer(chat) for chat in missing))
+        except Exception as e:
+            logger.error(f"Error syncing shard state: {e}")
+
+async def supervise():
+    async def run_worker(session):
+        while True:
+            process = await asyncio.create_subprocess_exec(
+                sys.executable, os.path.abspath(__file__),
+                env={**os.environ, "FORWARD_WORKER_SESSION": session}
+            )
+            code = await process.wait()
+            logger.warning(f"Worker {session} exited with code {code}, restarting in {RETRY_DELAY} seconds")
+            await asyncio.sleep(RETRY_DELAY)
+
+    if not WORKER_SESSIONS:
+        logger.error("Supervisor mode needs WORKER_SESSIONS")
+        return
+    # Every session must be logged in once beforehand (FORWARD_WORKER_SESSION=<session> python bot.py)
+    ring = HashRing(WORKER_SESSIONS)
+    load_mappings()
+    sources = {mapping.source_id for pairs in channel_mappings.values() for mapping in pairs.values()}
+    for session in WORKER_SESSIONS:
+        owned = sum(1 for source in sources if source is not None and ring.owner(source) == session)
+        logger.info(f"Starting worker {session} for {owned} of {len(sources)} sources")
+    await asyncio.gather(*(run_worker(session) for session in WORKER_SESSIONS))
+
+def queue_for_retry(message, user_id, pair_name):
+    live_arrivals.pop((message.chat_id, message.id), None)
+    retry_queue.push(user_id, pair_name, message.chat_id, message.id)
+    pair_stats[user_id][pair_name]['queued'] += 1
+
+def spill_to_retry(items):
+    for message, user_id, pair_name in items:
+        queue_for_retry(message, user_id, pair_name)
+
+async def drain_pair_queue(user_id, pair_name, semaphore):
+    async with semaphore:
+        while connected.is_set():
+            entries = retry_queue.pair_entries(user_id, pair_name, QUEUE_FETCH_BATCH)
+            if not entries and (user_id, pair_name) in send_scheduler.spilled_pairs:
+                # Spills still queued in the writer count too; once they are in and drained, the lane takes the pair back
+                await state_writer.submit(lambda db: None)
+                entries = retry_queue.pair_entries(user_id, pair_name, QUEUE_FETCH_BATCH)
+                if not entries:
+                    send_scheduler.spill_drained(user_id, pair_name)
+            if not entries or entries[0].next_attempt > time.time():
+                return
+            mapping = channel_mappings.get(user_id, {}).get(pair_name)
+            if mapping is None:
+                # Awaited, as the next read of the queue must not see these entries again
+                for entry in entries:
+                    await retry_queue.dead_letter(entry, "pair no longer exists")
+                continue
+            if not mapping.active:
+                return
+            # Fetch one batch of messages from the same source in a single request
+            source_chat = entries[0].source_chat
+            entries = [entry for entry in entries if entry.source_chat == source_chat]
+            try:
+                messages = await client.get_messages(peer(source_chat), ids=[entry.message_id for entry in entries])
+            except (errors.RPCError, ConnectionError) as e:
+                logger.warning(f"Could not fetch queued messages for pair '{pair_name}': {e}")
+                return
+            fetched = []
+            for entry, message in zip(entries, messages):
+                if message is None:
+                    await retry_queue.dead_letter(entry, "source message no longer exists")
+                else:
+                    fetched.append((entry, message))
+            for group in group_album_parts(fetched, message_of=lambda item: item[1]):
+                # Through the destination's lane, so retries never run alongside its live sends
+                if len(group) > 1:
+                    job, target = forward_album_with_retry, [message for _, message in group]
+                else:
+                    job, target = forward_message_with_retry, group[0][1]
+                success = await send_scheduler.submit(
+                    mapping.destination_id, job, target, mapping, user_id, pair_name, pairs=[(user_id, pair_name)]
+                )
+                if not success:
+                    # Keep the pair's FIFO order: stop here and let the backoff expire
+                    for entry, _ in group:
+                        await retry_queue.reschedule(entry, "forwarding failed")
+                    return
+                for entry, _ in group:
+                    await retry_queue.remove(entry)
 
 async def process_message_queue():
-    while message_queue and is_connected:
-        message_data = message_queue.popleft()
-        await forward_message_with_retry(*message_data)
+    if queue_drain_lock.locked():
+        return
+    async with queue_drain_lock:
+        due_pairs = [pair for pair in retry_queue.due_pairs(time.time()) if owns_pair(*pair)]
+        if not due_pairs:
+            return
+        logger.info(f"Draining retry queue for {len(due_pairs)} pairs")
+        semaphore = asyncio.Semaphore(QUEUE_DRAIN_CONCURRENCY)
+        await asyncio.gather(*(drain_pair_queue(user_id, pair_name, semaphore) for user_id, pair_name in due_pairs))
+
+async def run_retry_queue():
+    while True:
+        await asyncio.sleep(RETRY_POLL_INTERVAL)
+        if connected.is_set():
+            try:
+                await process_message_queue()
+            except Exception as e:
+                logger.error(f"Error processing retry queue: {e}")
 
 def filter_blacklisted_words(text, blacklist):
     if not text or not blacklist:
@@ -85,9 +1750,7 @@ def check_blocked_sentences(text, blocked_sentences):
 def filter_urls(text, block_urls):
     if not text or not block_urls:
         return text
-    url_pattern = r'https?://(?:[-\w.]|(?:%[\da-fA-F]{2}))+(?:/[^\s]*)?'
-    import re
-    return re.sub(url_pattern, '[URL REMOVED]', text)
+    return URL_PATTERN.sub('[URL REMOVED]', text)
 
 def remove_header_footer(text, header_pattern, footer_pattern):
     if not text:
@@ -98,6 +1761,12 @@ def remove_header_footer(text, header_pattern, footer_pattern):
         text = text[:-len(footer_pattern)].strip()
     return text
 
+def remove_mentions(text):
+    if not text:
+        return text
+    text = MENTION_PATTERN.sub('', text)
+    return WHITESPACE_PATTERN.sub(' ', text).strip()
+
 def apply_custom_header_footer(text, custom_header, custom_footer):
     if not text:
         return text
@@ -108,231 +1777,558 @@ def apply_custom_header_footer(text, custom_header, custom_footer):
         result = f"{result.rstrip()} {custom_footer}"
     return result.strip()
 
-async def forward_message_with_retry(event, mapping, user_id, pair_name):
+def _trie_suffixes(node):
+    suffixes, stack = [], [(node, '')]
+    while stack:
+        node, prefix = stack.pop()
+        for char, child in node.items():
+            if char:
+                stack.append((child, prefix + char))
+            else:
+                suffixes.append(prefix)
+    return suffixes
+
+def _trie_to_regex(root):
+    # Emitted with an explicit stack: words that extend one another open one group per word. Below
+    # TRIE_MAX_DEPTH groups a subtree becomes a flat longest-first alternation, as re.compile recurses too
+    parts = []
+    stack = [(root, 0)]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, str):
+            parts.append(item)
+            continue
+        node, depth = item
+        while len(node) == 1 and '' not in node:
+            (char, node), = node.items()
+            parts.append(re.escape(char))
+        optional = '' in node
+        children = [(char, child) for char, child in sorted(node.items()) if char]
+        if not children:
+            continue
+        if depth >= TRIE_MAX_DEPTH:
+            suffixes = sorted((suffix for suffix in _trie_suffixes(node) if suffix), key=lambda suffix: (-len(suffix), suffix))
+            parts.append(f"(?:{'|'.join(map(re.escape, suffixes))})" + ('?' if optional else ''))
+            continue
+        grouped = optional or len(children) > 1
+        work = ['(?:'] if grouped else []
+        for index, (char, child) in enumerate(children):
+            if index:
+                work.append('|')
+            work.append(re.escape(char))
+            work.append((child, depth + grouped))
+        if grouped:
+            work.append(')?' if optional else ')')
+        stack.extend(reversed(work))
+    return ''.join(parts)
+
+def compile_word_pattern(words):
+    # Builds one regex shaped like a trie, so a single scan finds the longest word at each position
+    trie = {}
+    for word in words:
+        if not word:
+            continue
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = {}
+    return re.compile(_trie_to_regex(trie)) if trie else None
+
+@dataclass(frozen=True)
+class PairMatchers:
+    blacklist_pattern: object
+    sentence_pattern: object
+    # Lowercased sentence -> sentence as the user entered it
+    sentence_lookup: dict
+
+    def filter_blacklist(self, text):
+        if not text or not self.blacklist_pattern:
+            return text
+        return self.blacklist_pattern.sub("***", text)
+
+    def find_blocked_sentence(self, text):
+        if not text or not self.sentence_pattern:
+            return None
+        match = self.sentence_pattern.search(text.lower())
+        return self.sentence_lookup[match.group()] if match else None
+
+def compile_matchers(mapping):
+    sentence_lookup = {}
+    for sentence in mapping.get('blocked_sentences') or ():
+        if sentence:
+            sentence_lookup.setdefault(sentence.lower(), sentence)
+    return PairMatchers(
+        blacklist_pattern=compile_word_pattern(mapping.get('blacklist') or ()),
+        sentence_pattern=compile_word_pattern(sentence_lookup),
+        sentence_lookup=sentence_lookup
+    )
+
+@dataclass(frozen=True)
+class PairPipeline:
+    # Each stage is (name, fn) where fn(text) returns (text, block_reason)
+    stages: tuple
+    custom_header: str
+    custom_footer: str
+    link_preview: bool
+
+    @property
+    def is_noop(self):
+        return not self.stages and not self.custom_header and not self.custom_footer
+
+    def run(self, text, has_media):
+        for _, stage in self.stages:
+            text, block_reason = stage(text)
+            if block_reason:
+                return text, block_reason
+        if not text.strip() and not has_media:
+            return text, "empty after filtering"
+        if self.custom_header or self.custom_footer:
+            text = apply_custom_header_footer(text, self.custom_header, self.custom_footer)
+        return text, None
+
+    def run_traced(self, text, has_media, trace):
+        # Same as run, recording a span per stage
+        for name, stage in self.stages:
+            with trace.span(f"filter:{name}"):
+                text, block_reason = stage(text)
+            if block_reason:
+                return text, block_reason
+        if not text.strip() and not has_media:
+            return text, "empty after filtering"
+        if self.custom_header or self.custom_footer:
+            with trace.span("filter:custom_header_footer"):
+                text = apply_custom_header_footer(text, self.custom_header, self.custom_footer)
+        return text, None
+
+def compile_pipeline(mapping, matchers=None):
+    if matchers is None:
+        matchers = compile_matchers(mapping)
+    stages = []
+    if matchers.sentence_pattern:
+        def block_sentence_stage(text):
+            matching_sentence = matchers.find_blocked_sentence(text)
+            return text, f"blocked sentence '{matching_sentence}'" if matching_sentence else None
+        stages.append(('blocked_sentences', block_sentence_stage))
+
+    if matchers.blacklist_pattern:
+        def blacklist_stage(text):
+            if not text:
+                return text, None
+            text = matchers.filter_blacklist(text)
+            return text, "blacklist filter" if text.strip() == "***" else None
+        stages.append(('blacklist', blacklist_stage))
+
+    if mapping.get('block_urls', False):
+        stages.append(('urls', lambda text: (filter_urls(text, True), None)))
+
+    header_pattern = mapping.get('header_pattern', '')
+    footer_pattern = mapping.get('footer_pattern', '')
+    if header_pattern or footer_pattern:
+        stages.append(('header_footer', lambda text: (remove_header_footer(text, header_pattern, footer_pattern), None)))
+
+    if mapping.get('remove_mentions', False):
+        stages.append(('mentions', lambda text: (remove_mentions(text), None)))
+
+    return PairPipeline(
+        stages=tuple(stages),
+        custom_header=mapping.get('custom_header', ''),
+        custom_footer=mapping.get('custom_footer', ''),
+        link_preview=not mapping.get('block_urls', False)
+    )
+
+def get_pipeline(user_id, pair_name, mapping):
+    pipeline = pair_pipelines.get((user_id, pair_name))
+    if pipeline is None:
+        matchers = pair_matchers.get((user_id, pair_name))
+        if matchers is None:
+            matchers = pair_matchers[(user_id, pair_name)] = compile_matchers(mapping)
+        pipeline = pair_pipelines[(user_id, pair_name)] = compile_pipeline(mapping, matchers)
+    return pipeline
+
+def invalidate_pipeline(user_id, pair_name, matchers=False):
+    pair_pipelines.pop((user_id, pair_name), None)
+    if matchers:
+        pair_matchers.pop((user_id, pair_name), None)
+
+async def rebuild_matchers(user_id, pair_name, mapping):
+    # A 10k-word list takes a fair part of a second to compile, so it is built in an executor while
+    # messages keep using the previous matchers; the lists are tuples, so a newer edit is easy to spot
+    lists = (mapping.blacklist, mapping.blocked_sentences)
+    matchers = await asyncio.get_running_loop().run_in_executor(None, compile_matchers, mapping)
+    current = channel_mappings.get(user_id, {}).get(pair_name)
+    if current is mapping and (mapping.blacklist, mapping.blocked_sentences) == lists:
+        pair_matchers[(user_id, pair_name)] = matchers
+        pair_pipelines.pop((user_id, pair_name), None)
+
+async def build_matchers(mappings):
+    # {(user_id, pair_name): mapping} -> {(user_id, pair_name): matchers}, compiled in the executor
+    loop = asyncio.get_running_loop()
+    built = await asyncio.gather(*(loop.run_in_executor(None, compile_matchers, mapping) for mapping in mappings.values()))
+    return dict(zip(mappings, built))
+
+async def warm_matchers():
+    await asyncio.gather(*(
+        rebuild_matchers(user_id, pair_name, mapping)
+        for user_id, pairs in channel_mappings.items() for pair_name, mapping in pairs.items()
+        if (mapping.blacklist or mapping.blocked_sentences) and (user_id, pair_name) not in pair_matchers
+    ))
+
+class SendFailed(Exception):
+    pass
+
+async def call_with_retry(destination, rpc, action, passthrough=()):
+    # Runs one rate-limited RPC up to MAX_RETRIES times; a flood wait throttles the destination's lane and
+    # uses up an attempt. Errors in passthrough are raised for the caller to handle, anything else that is
+    # left once the attempts are spent, or is not a Telegram or connection error, raises SendFailed
     for attempt in range(MAX_RETRIES):
         try:
-            message_text = event.message.text or event.message.raw_text or ""
-            if mapping.get('blocked_sentences'):
-                should_block, matching_sentence = check_blocked_sentences(message_text, mapping['blocked_sentences'])
-                if should_block:
-                    logger.info(f"Message blocked due to blocked sentence: '{matching_sentence}'")
-                    pair_stats[user_id][pair_name]['blocked'] += 1
-                    return True
-
-            if mapping.get('blacklist') and message_text:
-                message_text = filter_blacklisted_words(message_text, mapping['blacklist'])
-                if message_text.strip() == "***":
-                    logger.info("Message entirely blocked due to blacklist filter")
-                    pair_stats[user_id][pair_name]['blocked'] += 1
-                    return True
-
-            if mapping.get('block_urls', False) and message_text:
-                message_text = filter_urls(message_text, mapping['block_urls'])
-
-            if (mapping.get('header_pattern') or mapping.get('footer_pattern')) and message_text:
-                message_text = remove_header_footer(
-                    message_text,
-                    mapping.get('header_pattern', ''),
-                    mapping.get('footer_pattern', '')
-                )
-
-            if mapping.get('remove_mentions', False) and message_text:
-                import re
-                message_text = re.sub(r'@[a-zA-Z0-9_]+|\[([^\]]+)\]\(tg://user\?id=\d+\)', '', message_text)
-                message_text = re.sub(r'\s+', ' ', message_text).strip()
-
-            if not message_text.strip() and not event.message.media:
-                logger.info("Message skipped: empty after filtering")
-                pair_stats[user_id][pair_name]['blocked'] += 1
-                return True
-
-            # Apply custom header and footer
-            message_text = apply_custom_header_footer(
-                message_text,
-                mapping.get('custom_header', ''),
-                mapping.get('custom_footer', '')
-            )
-
-            reply_to = await handle_reply_mapping(event, mapping)
-            media = event.message.media
-            # Check if the media is a webpage preview
-            is_webpage = isinstance(media, MessageMediaWebPage)
-            # Only enable link preview if it's a webpage and URLs aren't blocked
-            has_url_preview = is_webpage and not mapping.get('block_urls', False)
-
-            # Prepare parameters for sending the message
-            send_params = {
-                'entity': int(mapping['destination']),
-                'message': message_text,
-                'link_preview': has_url_preview,
-                'reply_to': reply_to,
-                'silent': event.message.silent,
-                'formatting_entities': event.message.entities
-            }
-
-            # Only include the file parameter if media exists and it's not a webpage
-            if media and not is_webpage:
-                send_params['file'] = media
-
-            sent_message = await client.send_message(**send_params)
-
-            await store_message_mapping(event, mapping, sent_message)
-            pair_stats[user_id][pair_name]['forwarded'] += 1
-            pair_stats[user_id][pair_name]['last_activity'] = datetime.now().isoformat()
-            logger.info(f"Message forwarded from {mapping['source']} to {mapping['destination']} (ID: {sent_message.id})")
-            return True
-
+            await send_scheduler.acquire(destination)
+            result = await rpc()
+            send_scheduler.success(destination)
+            return result
+        except passthrough:
+            raise
         except errors.FloodWaitError as e:
-            wait_time = e.seconds
-            logger.warning(f"Flood wait error, sleeping for {wait_time} seconds...")
-            await asyncio.sleep(wait_time)
+            # The next attempt waits in the destination's lane instead of sleeping here
+            logger.warning(f"Flood wait error while {action}, throttling {destination} for {e.seconds} seconds...")
+            send_scheduler.flood_wait(destination, e.seconds)
+            failure = e
         except (errors.RPCError, ConnectionError) as e:
-            logger.warning(f"Attempt {attempt + 1} failed: {e}")
+            logger.warning(f"{action.capitalize()} in {destination} failed (attempt {attempt + 1}): {e}")
+            metrics.inc('send_retries_total', destination=destination)
+            failure = e
             if attempt < MAX_RETRIES - 1:
                 await asyncio.sleep(RETRY_DELAY)
-            else:
-                logger.error(f"Failed to forward message after {MAX_RETRIES} attempts")
-                return False
         except Exception as e:
-            logger.error(f"Unexpected error forwarding message: {e}")
-            return False
-
-async def edit_forwarded_message(event, mapping, user_id, pair_name):
-    try:
-        mapping_key = f"{mapping['source']}:{event.message.id}"
-        if not hasattr(client, 'forwarded_messages'):
-            logger.warning("No forwarded_messages attribute found on client")
-            return
-        if mapping_key not in client.forwarded_messages:
-            logger.warning(f"No mapping found for message: {mapping_key}")
-            return
-
-        forwarded_msg_id = client.forwarded_messages[mapping_key]
-        forwarded_msg = await client.get_messages(int(mapping['destination']), ids=forwarded_msg_id)
-        if not forwarded_msg:
-            logger.warning(f"Forwarded message {forwarded_msg_id} not found in destination {mapping['destination']}")
-            del client.forwarded_messages[mapping_key]
-            return
-
-        message_text = event.message.text or event.message.raw_text or ""
-        if mapping.get('blocked_sentences'):
-            should_block, matching_sentence = check_blocked_sentences(message_text, mapping['blocked_sentences'])
-            if should_block:
-                await client.delete_messages(int(mapping['destination']), [forwarded_msg_id])
-                logger.info(f"Forwarded message {forwarded_msg_id} deleted due to blocked sentence: '{matching_sentence}'")
-                pair_stats[user_id][pair_name]['blocked'] += 1
-                return
-
-        if mapping.get('blacklist') and message_text:
-            message_text = filter_blacklisted_words(message_text, mapping['blacklist'])
-            if message_text.strip() == "***":
-                await client.delete_messages(int(mapping['destination']), [forwarded_msg_id])
-                logger.info(f"Forwarded message {forwarded_msg_id} deleted due to blacklist filter")
-                pair_stats[user_id][pair_name]['blocked'] += 1
-                return
-
-        if mapping.get('block_urls', False) and message_text:
-            message_text = filter_urls(message_text, mapping['block_urls'])
-
-        if (mapping.get('header_pattern') or mapping.get('footer_pattern')) and message_text:
-            message_text = remove_header_footer(
-                message_text,
-                mapping.get('header_pattern', ''),
-                mapping.get('footer_pattern', '')
-            )
-
-        if mapping.get('remove_mentions', False) and message_text:
-            import re
-            message_text = re.sub(r'@[a-zA-Z0-9_]+|\[([^\]]+)\]\(tg://user\?id=\d+\)', '', message_text)
-            message_text = re.sub(r'\s+', ' ', message_text).strip()
+            logger.error(f"Unexpected error while {action} in {destination}: {e}")
+            raise SendFailed(action) from e
+    logger.error(f"{action.capitalize()} in {destination} failed after {MAX_RETRIES} attempts")
+    raise SendFailed(action) from failure
+
+@traced(lambda message, mapping, user_id, pair_name: f"forward {mapping['source']}/{message.id} → {mapping['destination']} ({pair_name})")
+async def forward_message_with_retry(message, mapping, user_id, pair_name):
+    pipeline = get_pipeline(user_id, pair_name, mapping)
+    message_text = message.text or message.raw_text or ""
+    message_text, block_reason = run_pipeline(pipeline, message_text, bool(message.media), user_id, pair_name)
+    if block_reason:
+        message_log.info(f"Message blocked: {block_reason}", extra=log_fields(user_id, pair_name, mapping['source'], mapping['destination'], message.id))
+        pair_stats[user_id][pair_name]['blocked'] += 1
+        return True
+
+    destination = mapping.destination_id
+    digest, skip = await check_duplicate(mapping, destination, message_text, [message.media], user_id, pair_name)
+    if skip:
+        message_log.info(f"Duplicate of a recent post skipped for {destination} (source {mapping['source']}, ID: {message.id})", extra=log_fields(user_id, pair_name, mapping['source'], mapping['destination'], message.id))
+        return True
+    with trace_span('reply_mapping'):
+        reply_to = await handle_reply_mapping(message, mapping)
+    media = message.media
+    # Check if the media is a webpage preview
+    is_webpage = isinstance(media, MessageMediaWebPage)
+    # Only enable link preview if it's a webpage and URLs aren't blocked
+    has_url_preview = is_webpage and pipeline.link_preview
+
+    # Prepare parameters for sending the message
+    send_params = {
+        'entity': peer(destination),
+        'message': message_text,
+        'link_preview': has_url_preview,
+        'reply_to': reply_to,
+        'silent': message.silent,
+        'formatting_entities': message.entities
+    }
 
-        if not message_text.strip() and not event.message.media:
-            await client.delete_messages(int(mapping['destination']), [forwarded_msg_id])
-            logger.info(f"Forwarded message {forwarded_msg_id} deleted: empty after filtering")
-            pair_stats[user_id][pair_name]['blocked'] += 1
-            return
+    # Only include the file parameter if media exists and it's not a webpage
+    if media and not is_webpage:
+        send_params['file'] = media
 
-        # Apply custom header and footer on edit
-        message_text = apply_custom_header_footer(
-            message_text,
-            mapping.get('custom_header', ''),
-            mapping.get('custom_footer', '')
+    try:
+        sent_message = await call_with_retry(
+            destination, lambda: timed_rpc('send_message', destination, client.send_message(**send_params)),
+            "forwarding a message"
+        )
+    except SendFailed:
+        content_hashes.release(destination, [digest])
+        return False
+
+    with trace_span('store_mapping'):
+        await store_message_mapping(message, mapping, sent_message)
+    if digest:
+        content_hashes.add(destination, digest)
+    observe_delivery(message, user_id, pair_name)
+    pair_stats[user_id][pair_name]['forwarded'] += 1
+    pair_stats[user_id][pair_name]['last_activity'] = datetime.now().isoformat()
+    message_log.info(f"Message forwarded from {mapping['source']} to {mapping['destination']} (ID: {sent_message.id})", extra=log_fields(user_id, pair_name, mapping['source'], mapping['destination'], message.id))
+    return True
+
+@traced(lambda messages, mapping, user_id, pair_name: f"album {mapping['source']}/{messages[0].id}+{len(messages) - 1} → {mapping['destination']} ({pair_name})")
+async def forward_album_with_retry(messages, mapping, user_id, pair_name):
+    pipeline = get_pipeline(user_id, pair_name, mapping)
+    # Albums carry their caption on one part; it is filtered once for the whole album
+    caption_index = next((i for i, m in enumerate(messages) if m.text or m.raw_text), None)
+    caption = ""
+    if caption_index is not None:
+        caption = messages[caption_index].text or messages[caption_index].raw_text
+    caption, block_reason = run_pipeline(pipeline, caption, True, user_id, pair_name)
+    if block_reason:
+        message_log.info(f"Album blocked: {block_reason}", extra=log_fields(user_id, pair_name, mapping['source'], mapping['destination'], messages[0].id))
+        pair_stats[user_id][pair_name]['blocked'] += 1
+        return True
+
+    parts = [m for m in messages if m.media and not isinstance(m.media, MessageMediaWebPage)]
+    captions = ["" for _ in parts]
+    entities = None
+    position = next((i for i, m in enumerate(parts) if caption_index is not None and m is messages[caption_index]), None)
+    if position is not None:
+        captions[position] = caption
+        if messages[caption_index].entities:
+            entities = [messages[caption_index].entities if i == position else [] for i in range(len(parts))]
+    elif caption:
+        captions[0] = caption
+
+    destination = mapping.destination_id
+    digest, skip = await check_duplicate(mapping, destination, caption, [m.media for m in parts], user_id, pair_name)
+    if skip:
+        message_log.info(f"Duplicate of a recent album skipped for {destination} (source {mapping['source']})", extra=log_fields(user_id, pair_name, mapping['source'], mapping['destination'], messages[0].id))
+        return True
+    reply_to = await handle_reply_mapping(messages[0], mapping)
+    try:
+        sent_messages = await call_with_retry(destination, lambda: timed_rpc('send_file', destination, client.send_file(
+            peer(destination),
+            [m.media for m in parts],
+            caption=captions,
+            formatting_entities=entities,
+            reply_to=reply_to,
+            silent=messages[0].silent
+        )), "forwarding an album")
+    except SendFailed:
+        content_hashes.release(destination, [digest])
+        return False
+
+    for message, sent_message in zip(parts, sent_messages):
+        await store_message_mapping(message, mapping, sent_message)
+    if digest:
+        content_hashes.add(destination, digest)
+    observe_delivery(messages[0], user_id, pair_name)
+    pair_stats[user_id][pair_name]['forwarded'] += len(sent_messages)
+    pair_stats[user_id][pair_name]['last_activity'] = datetime.now().isoformat()
+    message_log.info(f"Album of {len(sent_messages)} forwarded from {mapping['source']} to {mapping['destination']}", extra=log_fields(user_id, pair_name, mapping['source'], mapping['destination'], messages[0].id))
+    return True
+
+@traced(lambda entries, source, destination, drop_author: f"forward batch {source}/{entries[0][0].id}+{len(entries) - 1} → {destination}")
+async def forward_batch_with_retry(entries, source, destination, drop_author):
+    kept, digests = [], []
+    for message, user_id, pair_name, mapping in entries:
+        text = message.text or message.raw_text or ""
+        digest, skip = await check_duplicate(mapping, destination, text, [message.media], user_id, pair_name)
+        if not skip:
+            kept.append((message, user_id, pair_name, mapping))
+            digests.append(digest)
+    if len(kept) < len(entries):
+        message_log.info(
+            f"{len(entries) - len(kept)} duplicate(s) of recent posts skipped for {destination} (source {source})",
+            extra=log_fields(source=source, destination=destination)
         )
+    entries = kept
+    if not entries:
+        return True
+    message_ids = [message.id for message, _, _, _ in entries]
+    try:
+        sent_messages = await call_with_retry(destination, lambda: timed_rpc('forward_messages', destination, client.forward_messages(
+            peer(destination),
+            message_ids,
+            from_peer=peer(source),
+            drop_author=drop_author,
+            silent=all(message.silent for message, _, _, _ in entries)
+        )), "forwarding messages", passthrough=errors.ChatForwardsRestrictedError)
+    except errors.ChatForwardsRestrictedError:
+        # Protected sources cannot be forwarded server-side; copy them instead
+        logger.warning(f"Forwarding from {source} is restricted, copying {len(entries)} message(s) instead")
+        restricted_sources[source] = time.monotonic()
+        content_hashes.release(destination, digests)
+        for message, user_id, pair_name, mapping in entries:
+            await forward_to_pair(message, user_id, pair_name, mapping)
+        return True
+    except SendFailed:
+        content_hashes.release(destination, digests)
+        return False
+
+    for (message, user_id, pair_name, mapping), sent_message in zip(entries, sent_messages):
+        if sent_message is None:
+            continue
+        await store_message_mapping(message, mapping, sent_message)
+        observe_delivery(message, user_id, pair_name)
+        pair_stats[user_id][pair_name]['forwarded'] += 1
+        pair_stats[user_id][pair_name]['last_activity'] = datetime.now().isoformat()
+    for digest in digests:
+        if digest:
+            content_hashes.add(destination, digest)
+    message_log.info(
+        f"{len(message_ids)} message(s) forwarded from {source} to {destination}",
+        extra=log_fields(source=source, destination=destination, message_id=message_ids[0])
+    )
+    return True
+
+def group_album_parts(items, message_of=lambda item: item):
+    # Splits consecutive items into album groups; messages outside an album form their own group
+    for _, group in itertools.groupby(items, key=lambda item: message_of(item).grouped_id or -message_of(item).id):
+        yield list(group)
+
+@traced(lambda message, mapping, user_id, pair_name: f"edit {mapping['source']}/{message.id} → {mapping['destination']} ({pair_name})")
+async def edit_forwarded_message(message, mapping, user_id, pair_name):
+    source_chat = mapping.source_id
+    destination = mapping.destination_id
+    forwarded_msg_id = message_store.get(source_chat, message.id, destination)
+    if forwarded_msg_id is None:
+        logger.warning(f"No mapping found for message {message.id} from {source_chat} to {destination}")
+        return
 
-        media = event.message.media
-        is_webpage = isinstance(media, MessageMediaWebPage)
-        has_url_preview = is_webpage and not mapping.get('block_urls', False)
-
-        # Prepare parameters for editing the message
-        edit_params = {
-            'entity': int(mapping['destination']),
-            'message': forwarded_msg_id,
-            'text': message_text,
-            'link_preview': has_url_preview,
-            'formatting_entities': event.message.entities
-        }
+    pipeline = get_pipeline(user_id, pair_name, mapping)
+    message_text = message.text or message.raw_text or ""
+    message_text, block_reason = run_pipeline(pipeline, message_text, bool(message.media), user_id, pair_name)
+    if block_reason:
+        queue_delete(destination, [forwarded_msg_id])
+        message_store.discard(source_chat, message.id, destination)
+        message_log.info(f"Forwarded message {forwarded_msg_id} deleted: {block_reason}", extra=log_fields(user_id, pair_name, source_chat, destination, message.id))
+        pair_stats[user_id][pair_name]['blocked'] += 1
+        return
 
-        # Only include file if media exists and it's not a webpage
-        if media and not is_webpage:
-            edit_params['file'] = media
+    media = message.media
+    is_webpage = isinstance(media, MessageMediaWebPage)
+    has_url_preview = is_webpage and pipeline.link_preview
+
+    # Prepare parameters for editing the message
+    edit_params = {
+        'entity': peer(destination),
+        'message': forwarded_msg_id,
+        'text': message_text,
+        'link_preview': has_url_preview,
+        'formatting_entities': message.entities
+    }
 
-        await client.edit_message(**edit_params)
-        pair_stats[user_id][pair_name]['edited'] += 1
-        pair_stats[user_id][pair_name]['last_activity'] = datetime.now().isoformat()
-        logger.info(f"Forwarded message {forwarded_msg_id} edited in {mapping['destination']}")
+    # Only include file if media exists and it's not a webpage
+    if media and not is_webpage:
+        edit_params['file'] = media
 
+    try:
+        await call_with_retry(
+            destination, lambda: timed_rpc('edit_message', destination, client.edit_message(**edit_params)),
+            f"editing message {forwarded_msg_id}",
+            passthrough=(errors.MessageNotModifiedError, errors.MessageAuthorRequiredError, errors.MessageIdInvalidError)
+        )
+    except errors.MessageNotModifiedError:
+        return
     except errors.MessageAuthorRequiredError:
         logger.error(f"Cannot edit message {forwarded_msg_id}: Bot must be the original author")
+        return
     except errors.MessageIdInvalidError:
+        # The forwarded copy was deleted in the destination
         logger.error(f"Cannot edit message {forwarded_msg_id}: Message ID is invalid or deleted")
-        if mapping_key in client.forwarded_messages:
-            del client.forwarded_messages[mapping_key]
-    except errors.FloodWaitError as e:
-        logger.warning(f"Flood wait error while editing, sleeping for {e.seconds} seconds...")
-        await asyncio.sleep(e.seconds)
-    except Exception as e:
-        logger.error(f"Error editing forwarded message {forwarded_msg_id}: {e}")
+        message_store.discard(source_chat, message.id, destination)
+        return
+    except SendFailed:
+        return
+    pair_stats[user_id][pair_name]['edited'] += 1
+    pair_stats[user_id][pair_name]['last_activity'] = datetime.now().isoformat()
+    message_log.info(f"Forwarded message {forwarded_msg_id} edited in {mapping['destination']}", extra=log_fields(user_id, pair_name, source_chat, destination, message.id))
+
+def queue_delete(destination, message_ids):
+    pending_ids, timer = pending_deletes.get(destination, ([], None))
+    pending_ids.extend(message_ids)
+    if timer is None:
+        timer = asyncio.get_running_loop().call_later(DELETE_BATCH_WINDOW, flush_deletes, destination)
+    pending_deletes[destination] = (pending_ids, timer)
+
+def flush_deletes(destination):
+    message_ids, _ = pending_deletes.pop(destination, ([], None))
+    if message_ids:
+        send_scheduler.submit(destination, delete_from_destination, destination, message_ids, priority=PRIORITY_EDIT)
+
+async def delete_from_destination(destination, message_ids):
+    for start in range(0, len(message_ids), DELETE_CHUNK_SIZE):
+        chunk = message_ids[start:start + DELETE_CHUNK_SIZE]
+        try:
+            await call_with_retry(
+                destination, lambda: timed_rpc('delete_messages', destination, client.delete_messages(peer(destination), chunk)),
+                f"deleting {len(chunk)} message(s)"
+            )
+        except SendFailed:
+            continue
+        message_log.info(f"Deleted {len(chunk)} message(s) in {destination}", extra=log_fields(destination=destination))
 
-async def handle_reply_mapping(event, mapping):
-    if not hasattr(event.message, 'reply_to') or not event.message.reply_to:
+async def handle_reply_mapping(message, mapping):
+    if not hasattr(message, 'reply_to') or not message.reply_to:
         return None
     try:
-        source_reply_id = event.message.reply_to.reply_to_msg_id
+        source_reply_id = message.reply_to.reply_to_msg_id
         if not source_reply_id:
             return None
-        mapping_key = f"{mapping['source']}:{source_reply_id}"
-        if hasattr(client, 'forwarded_messages') and mapping_key in client.forwarded_messages:
-            return client.forwarded_messages[mapping_key]
-        replied_msg = await client.get_messages(int(mapping['source']), ids=source_reply_id)
-        if replied_msg and replied_msg.text:
-            dest_msgs = await client.get_messages(int(mapping['destination']), search=replied_msg.text[:20], limit=5)
-            if dest_msgs:
-                return dest_msgs[0].id
+        return message_store.get(mapping.source_id, source_reply_id, mapping.destination_id)
     except Exception as e:
         logger.error(f"Error handling reply mapping: {e}")
     return None
 
-async def store_message_mapping(event, mapping, sent_message):
+async def store_message_mapping(message, mapping, sent_message):
     try:
-        if not hasattr(event.message, 'id'):
+        if not hasattr(message, 'id'):
             return
-        if not hasattr(client, 'forwarded_messages'):
-            client.forwarded_messages = {}
-        if len(client.forwarded_messages) >= MAX_MAPPING_HISTORY:
-            oldest_key = next(iter(client.forwarded_messages))
-            client.forwarded_messages.pop(oldest_key)
-        source_msg_id = event.message.id
-        mapping_key = f"{mapping['source']}:{source_msg_id}"
-        client.forwarded_messages[mapping_key] = sent_message.id
+        message_store.add(mapping.source_id, message.id, mapping.destination_id, sent_message.id)
     except Exception as e:
         logger.error(f"Error storing message mapping: {e}")
 
-@client.on(events.NewMessage(pattern='(?i)^/start$'))
-async def start(event):
+# Command router: command name -> (handler, compiled argument pattern, usage, first argument names a pair, owner only)
+command_handlers = {}
+
+def command(name, args=None, usage=None, pair=False, owner=False):
+    def register(handler):
+        command_handlers[name] = (handler, re.compile(args, re.DOTALL) if args else None, usage or name, pair, owner)
+        return handler
+    return register
+
+def is_command_message(event):
+    # Channel and group traffic never reaches the router; in supervisor mode only the first session answers
+    return IS_PRIMARY and event.is_private and event.raw_text.startswith('/')
+
+@client.on(events.NewMessage(func=is_command_message))
+async def route_command(event):
+    name, _, arg_text = event.raw_text.partition(' ')
+    spec = command_handlers.get(name.lower())
+    if spec is None:
+        return
+    handler, arg_pattern, usage, needs_pair, owner_only = spec
+    # Commands that change or expose state shared by every user answer the account itself only
+    if owner_only and not (event.out or event.sender_id == MONITOR_CHAT_ID):
+        await event.reply("⛔ Only the account owner can use this command.")
+        return
+    arg_text = arg_text.strip()
+    if arg_pattern:
+        match = arg_pattern.fullmatch(arg_text)
+        if not match:
+            await event.reply(f"⚠️ Usage: {usage}")
+            return
+        args = match.groups()
+    elif arg_text:
+        await event.reply(f"⚠️ Usage: {usage}")
+        return
+    else:
+        args = ()
+    user_id = str(event.sender_id)
+    if needs_pair:
+        pair_name, args = args[0], args[1:]
+        mapping = channel_mappings.get(user_id, {}).get(pair_name)
+        if mapping is None:
+            await event.reply("⚠️ Pair not found.")
+            return
+        await handler(event, user_id, pair_name, mapping, *args)
+    else:
+        await handler(event, user_id, *args)
+
+@command('/start')
+async def start(event, user_id):
     await event.reply("✅ Bot is running! Use /commands to see available commands.")
 
-@client.on(events.NewMessage(pattern='(?i)^/commands$'))
-async def list_commands(event):
+@command('/commands')
+async def list_commands(event, user_id):
     commands = """
     📌 Available Commands:
     /setpair <name> <source> <destination> [remove_mentions]
@@ -340,14 +2336,21 @@ async def list_commands(event):
     /pausepair <name> - Pause a forwarding pair
     /startpair <name> - Resume a forwarding pair
     /clearpairs - Clear all forwarding pairs
+    /exportpairs [json|csv] - Download all pairs as a file
+    /importpairs [dry] [replace] - Add/update pairs from an attached .json/.csv file (replace also removes missing pairs)
     /togglementions <name> - Toggle mention removal
+    /toggleforwardheader <name> - Toggle the "Forwarded from" header on pairs without filters
     /monitor - Show detailed status of all pairs
+    /backfill <name> <count> - Copy the last <count> source messages to the destination
+    /trace [on|off|count] - Enable/disable stage tracing or show recent traces (account owner only)
+    /testfilters <name> <count> - Run the last <count> source messages through the pair's filters without sending
 
     📋 Filtering Commands:
     /addblacklist <name> <word1,word2,...> - Add words to blacklist
     /clearblacklist <name> - Clear blacklist for a pair
     /showblacklist <name> - Show blacklisted words
     /toggleurlblock <name> - Toggle blocking of URLs
+    /dedup <name> <off|count|skip> - Count or skip posts already sent to the destination recently
     /setheader <name> <pattern> - Set header pattern to remove
     /setfooter <name> <pattern> - Set footer pattern to remove
     /clearheaderfooter <name> - Clear header/footer patterns
@@ -364,234 +2367,257 @@ async def list_commands(event):
     """
     await event.reply(commands)
 
-@client.on(events.NewMessage(pattern='(?i)^/monitor$'))
-async def monitor_pairs(event):
-    user_id = str(event.sender_id)
+@command('/monitor')
+async def monitor_pairs(event, user_id):
     if user_id not in channel_mappings or not channel_mappings[user_id]:
         await event.reply("⚠️ No forwarding pairs found.")
         return
-    report = ["📊 Forwarding Pairs Monitor"]
-    total_queued = len(message_queue)
-    for pair_name, data in channel_mappings[user_id].items():
-        stats = pair_stats.get(user_id, {}).get(pair_name, {'forwarded': 0, 'edited': 0, 'blocked': 0, 'queued': 0, 'last_activity': None})
-        report.append(
-            f"\n🔹 {pair_name}: {data['source']} → {data['destination']}\n"
-            f"   Status: {'Active' if data['active'] else 'Paused'}\n"
-            f"   Forwarded: {stats['forwarded']}\n"
-            f"   Edited: {stats['edited']}\n"
-            f"   Blocked: {stats['blocked']}\n"
-            f"   Queued: {stats['queued']}\n"
-            f"   Last Activity: {stats['last_activity'] or 'N/A'}"
-        )
-    report.append(f"\n📥 Total Queued Messages: {total_queued}")
-    await event.reply("\n".join(report))
+    await event.reply(render_pair_report(user_id, "📊 Forwarding Pairs Monitor"))
 
-@client.on(events.NewMessage(pattern=r'/setpair (\S+) (\S+) (\S+)(?: (yes|no))?'))
-async def set_pair(event):
-    pair_name, source, destination, remove_mentions = event.pattern_match.groups()
-    user_id = str(event.sender_id)
+@command('/setpair', r'(\S+) (\S+) (\S+)(?: (yes|no))?', "/setpair <name> <source> <destination> [yes|no]")
+async def set_pair(event, user_id, pair_name, source, destination, remove_mentions):
     remove_mentions = remove_mentions == "yes"
     if user_id not in channel_mappings:
         channel_mappings[user_id] = {}
     if user_id not in pair_stats:
         pair_stats[user_id] = {}
-    channel_mappings[user_id][pair_name] = {
-        'source': source,
-        'destination': destination,
-        'active': True,
-        'remove_mentions': remove_mentions,
-        'blacklist': [],
-        'block_urls': False,
-        'header_pattern': '',
-        'footer_pattern': '',
-        'custom_header': '',
-        'custom_footer': '',
-        'blocked_sentences': []
-    }
-    pair_stats[user_id][pair_name] = {'forwarded': 0, 'edited': 0, 'blocked': 0, 'queued': 0, 'last_activity': None}
+    channel_mappings[user_id][pair_name] = default_mapping(source, destination, remove_mentions)
+    pair_stats[user_id][pair_name] = empty_pair_stats()
+    invalidate_pipeline(user_id, pair_name, matchers=True)
+    index_pair(user_id, pair_name)
     save_mappings()
     await event.reply(f"✅ Forwarding pair '{pair_name}' added: {source} → {destination} (Remove mentions: {remove_mentions})")
+    missing = [chat for chat in (source, destination) if not await resolve_peer(chat)]
+    if missing:
+        await event.reply(f"⚠️ Could not resolve {', '.join(missing)}; messages for '{pair_name}' will fail until it is reachable.")
 
-@client.on(events.NewMessage(pattern=r'/blocksentence (\S+) (.+)'))
-async def block_sentence(event):
-    pair_name = event.pattern_match.group(1)
-    sentence = event.pattern_match.group(2)
-    user_id = str(event.sender_id)
-    if user_id in channel_mappings and pair_name in channel_mappings[user_id]:
-        if 'blocked_sentences' not in channel_mappings[user_id][pair_name]:
-            channel_mappings[user_id][pair_name]['blocked_sentences'] = []
-        channel_mappings[user_id][pair_name]['blocked_sentences'].append(sentence)
-        save_mappings()
-        await event.reply(f"🚫 Added sentence to block list for '{pair_name}'.")
-    else:
-        await event.reply("⚠️ Pair not found.")
+def default_mapping(source, destination, remove_mentions=False):
+    return PairConfig(source, destination, remove_mentions=remove_mentions)
 
-@client.on(events.NewMessage(pattern='(?i)^/clearblocksentences (\S+)$'))
-async def clear_block_sentences(event):
-    pair_name = event.pattern_match.group(1)
-    user_id = str(event.sender_id)
-    if user_id in channel_mappings and pair_name in channel_mappings[user_id]:
-        channel_mappings[user_id][pair_name]['blocked_sentences'] = []
-        save_mappings()
-        await event.reply(f"🗑️ Block sentences list cleared for '{pair_name}'.")
-    else:
-        await event.reply("⚠️ Pair not found.")
+def empty_pair_stats():
+    return PairStats()
 
-@client.on(events.NewMessage(pattern='(?i)^/showblocksentences (\S+)$'))
-async def show_block_sentences(event):
-    pair_name = event.pattern_match.group(1)
-    user_id = str(event.sender_id)
-    if user_id in channel_mappings and pair_name in channel_mappings[user_id]:
-        blocked_sentences = channel_mappings[user_id][pair_name].get('blocked_sentences', [])
-        if blocked_sentences:
-            sentences_list = "\n".join([f"- {sentence}" for sentence in blocked_sentences])
-            await event.reply(f"📋 Blocked sentences for '{pair_name}':\n{sentences_list}")
-        else:
-            await event.reply(f"📋 No blocked sentences for '{pair_name}'.")
-    else:
-        await event.reply("⚠️ Pair not found.")
+@command('/blocksentence', r'(\S+) (.+)', "/blocksentence <name> <sentence>", pair=True)
+async def block_sentence(event, user_id, pair_name, mapping, sentence):
+    mapping['blocked_sentences'] += (sentence,)
+    await rebuild_matchers(user_id, pair_name, mapping)
+    save_mappings()
+    await event.reply(f"🚫 Added sentence to block list for '{pair_name}'.")
 
-@client.on(events.NewMessage(pattern=r'/addblacklist (\S+) (.+)'))
-async def add_blacklist(event):
-    pair_name = event.pattern_match.group(1)
-    words = event.pattern_match.group(2).split(',')
-    user_id = str(event.sender_id)
-    if user_id in channel_mappings and pair_name in channel_mappings[user_id]:
-        if 'blacklist' not in channel_mappings[user_id][pair_name]:
-            channel_mappings[user_id][pair_name]['blacklist'] = []
-        channel_mappings[user_id][pair_name]['blacklist'].extend([word.strip() for word in words])
-        channel_mappings[user_id][pair_name]['blacklist'] = list(set(channel_mappings[user_id][pair_name]['blacklist']))
-        save_mappings()
-        await event.reply(f"🚫 Added {len(words)} word(s) to blacklist for '{pair_name}'.")
+@command('/clearblocksentences', r'(\S+)', "/clearblocksentences <name>", pair=True)
+async def clear_block_sentences(event, user_id, pair_name, mapping):
+    mapping['blocked_sentences'] = []
+    await rebuild_matchers(user_id, pair_name, mapping)
+    save_mappings()
+    await event.reply(f"🗑️ Block sentences list cleared for '{pair_name}'.")
+
+@command('/showblocksentences', r'(\S+)', "/showblocksentences <name>", pair=True)
+async def show_block_sentences(event, user_id, pair_name, mapping):
+    blocked_sentences = mapping.get('blocked_sentences', [])
+    if blocked_sentences:
+        sentences_list = "\n".join([f"- {sentence}" for sentence in blocked_sentences])
+        await event.reply(f"📋 Blocked sentences for '{pair_name}':\n{sentences_list}")
     else:
-        await event.reply("⚠️ Pair not found.")
+        await event.reply(f"📋 No blocked sentences for '{pair_name}'.")
 
-@client.on(events.NewMessage(pattern='(?i)^/clearblacklist (\S+)$'))
-async def clear_blacklist(event):
-    pair_name = event.pattern_match.group(1)
-    user_id = str(event.sender_id)
-    if user_id in channel_mappings and pair_name in channel_mappings[user_id]:
-        channel_mappings[user_id][pair_name]['blacklist'] = []
-        save_mappings()
-        await event.reply(f"🗑️ Blacklist cleared for '{pair_name}'.")
-    else:
-        await event.reply("⚠️ Pair not found.")
+@command('/addblacklist', r'(\S+) (.+)', "/addblacklist <name> <word1,word2,...>", pair=True)
+async def add_blacklist(event, user_id, pair_name, mapping, words):
+    words = words.split(',')
+    mapping['blacklist'] = mapping.blacklist + tuple(word.strip() for word in words)
+    await rebuild_matchers(user_id, pair_name, mapping)
+    save_mappings()
+    await event.reply(f"🚫 Added {len(words)} word(s) to blacklist for '{pair_name}'.")
 
-@client.on(events.NewMessage(pattern='(?i)^/showblacklist (\S+)$'))
-async def show_blacklist(event):
-    pair_name = event.pattern_match.group(1)
-    user_id = str(event.sender_id)
-    if user_id in channel_mappings and pair_name in channel_mappings[user_id]:
-        blacklist = channel_mappings[user_id][pair_name].get('blacklist', [])
-        if blacklist:
-            words_list = ", ".join(blacklist)
-            await event.reply(f"📋 Blacklisted words for '{pair_name}':\n{words_list}")
-        else:
-            await event.reply(f"📋 No blacklisted words for '{pair_name}'.")
+@command('/clearblacklist', r'(\S+)', "/clearblacklist <name>", pair=True)
+async def clear_blacklist(event, user_id, pair_name, mapping):
+    mapping['blacklist'] = []
+    await rebuild_matchers(user_id, pair_name, mapping)
+    save_mappings()
+    await event.reply(f"🗑️ Blacklist cleared for '{pair_name}'.")
+
+@command('/showblacklist', r'(\S+)', "/showblacklist <name>", pair=True)
+async def show_blacklist(event, user_id, pair_name, mapping):
+    blacklist = mapping.get('blacklist', [])
+    if blacklist:
+        words_list = ", ".join(blacklist)
+        await event.reply(f"📋 Blacklisted words for '{pair_name}':\n{words_list}")
     else:
-        await event.reply("⚠️ Pair not found.")
+        await event.reply(f"📋 No blacklisted words for '{pair_name}'.")
 
-@client.on(events.NewMessage(pattern='(?i)^/toggleurlblock (\S+)$'))
-async def toggle_url_block(event):
-    pair_name = event.pattern_match.group(1)
-    user_id = str(event.sender_id)
-    if user_id in channel_mappings and pair_name in channel_mappings[user_id]:
-        current_status = channel_mappings[user_id][pair_name].get('block_urls', False)
-        channel_mappings[user_id][pair_name]['block_urls'] = not current_status
-        save_mappings()
-        status_text = "ENABLED" if not current_status else "DISABLED"
-        await event.reply(f"🔗 URL blocking {status_text} for '{pair_name}'.")
-    else:
-        await event.reply("⚠️ Pair not found.")
+@command('/toggleurlblock', r'(\S+)', "/toggleurlblock <name>", pair=True)
+async def toggle_url_block(event, user_id, pair_name, mapping):
+    current_status = mapping.get('block_urls', False)
+    mapping['block_urls'] = not current_status
+    invalidate_pipeline(user_id, pair_name)
+    save_mappings()
+    status_text = "ENABLED" if not current_status else "DISABLED"
+    await event.reply(f"🔗 URL blocking {status_text} for '{pair_name}'.")
 
-@client.on(events.NewMessage(pattern=r'/setheader (\S+) (.+)'))
-async def set_header(event):
-    pair_name = event.pattern_match.group(1)
-    pattern = event.pattern_match.group(2)
-    user_id = str(event.sender_id)
-    if user_id in channel_mappings and pair_name in channel_mappings[user_id]:
-        channel_mappings[user_id][pair_name]['header_pattern'] = pattern
-        save_mappings()
-        await event.reply(f"✂️ Header pattern set for '{pair_name}': '{pattern}'")
-    else:
-        await event.reply("⚠️ Pair not found.")
+@command('/dedup', r'(\S+) (off|count|skip)', "/dedup <name> <off|count|skip>", pair=True)
+async def set_dedup(event, user_id, pair_name, mapping, mode):
+    mapping['dedup'] = mode
+    save_mappings()
+    await event.reply(f"♻️ Duplicate suppression for '{pair_name}' set to {mode.upper()}.")
 
-@client.on(events.NewMessage(pattern=r'/setfooter (\S+) (.+)'))
-async def set_footer(event):
-    pair_name = event.pattern_match.group(1)
-    pattern = event.pattern_match.group(2)
-    user_id = str(event.sender_id)
-    if user_id in channel_mappings and pair_name in channel_mappings[user_id]:
-        channel_mappings[user_id][pair_name]['footer_pattern'] = pattern
-        save_mappings()
-        await event.reply(f"✂️ Footer pattern set for '{pair_name}': '{pattern}'")
-    else:
-        await event.reply("⚠️ Pair not found.")
+@command('/setheader', r'(\S+) (.+)', "/setheader <name> <pattern>", pair=True)
+async def set_header(event, user_id, pair_name, mapping, pattern):
+    mapping['header_pattern'] = pattern
+    invalidate_pipeline(user_id, pair_name)
+    save_mappings()
+    await event.reply(f"✂️ Header pattern set for '{pair_name}': '{pattern}'")
 
-@client.on(events.NewMessage(pattern='(?i)^/clearheaderfooter (\S+)$'))
-async def clear_header_footer(event):
-    pair_name = event.pattern_match.group(1)
-    user_id = str(event.sender_id)
-    if user_id in channel_mappings and pair_name in channel_mappings[user_id]:
-        channel_mappings[user_id][pair_name]['header_pattern'] = ''
-        channel_mappings[user_id][pair_name]['footer_pattern'] = ''
-        save_mappings()
-        await event.reply(f"🗑️ Header and footer patterns cleared for '{pair_name}'.")
-    else:
-        await event.reply("⚠️ Pair not found.")
+@command('/setfooter', r'(\S+) (.+)', "/setfooter <name> <pattern>", pair=True)
+async def set_footer(event, user_id, pair_name, mapping, pattern):
+    mapping['footer_pattern'] = pattern
+    invalidate_pipeline(user_id, pair_name)
+    save_mappings()
+    await event.reply(f"✂️ Footer pattern set for '{pair_name}': '{pattern}'")
 
-@client.on(events.NewMessage(pattern=r'/setcustomheader (\S+) (.+)'))
-async def set_custom_header(event):
-    pair_name = event.pattern_match.group(1)
-    text = event.pattern_match.group(2)
-    user_id = str(event.sender_id)
-    if user_id in channel_mappings and pair_name in channel_mappings[user_id]:
-        channel_mappings[user_id][pair_name]['custom_header'] = text
-        save_mappings()
-        await event.reply(f"📝 Custom header set for '{pair_name}': '{text}'")
-    else:
-        await event.reply("⚠️ Pair not found.")
+@command('/clearheaderfooter', r'(\S+)', "/clearheaderfooter <name>", pair=True)
+async def clear_header_footer(event, user_id, pair_name, mapping):
+    mapping['header_pattern'] = ''
+    mapping['footer_pattern'] = ''
+    invalidate_pipeline(user_id, pair_name)
+    save_mappings()
+    await event.reply(f"🗑️ Header and footer patterns cleared for '{pair_name}'.")
 
-@client.on(events.NewMessage(pattern=r'/setcustomfooter (\S+) (.+)'))
-async def set_custom_footer(event):
-    pair_name = event.pattern_match.group(1)
-    text = event.pattern_match.group(2)
-    user_id = str(event.sender_id)
-    if user_id in channel_mappings and pair_name in channel_mappings[user_id]:
-        channel_mappings[user_id][pair_name]['custom_footer'] = text
-        save_mappings()
-        await event.reply(f"📝 Custom footer set for '{pair_name}': '{text}' (added with a space before)")
-    else:
-        await event.reply("⚠️ Pair not found.")
+@command('/setcustomheader', r'(\S+) (.+)', "/setcustomheader <name> <text>", pair=True)
+async def set_custom_header(event, user_id, pair_name, mapping, text):
+    mapping['custom_header'] = text
+    invalidate_pipeline(user_id, pair_name)
+    save_mappings()
+    await event.reply(f"📝 Custom header set for '{pair_name}': '{text}'")
 
-@client.on(events.NewMessage(pattern='(?i)^/clearcustomheaderfooter (\S+)$'))
-async def clear_custom_header_footer(event):
-    pair_name = event.pattern_match.group(1)
-    user_id = str(event.sender_id)
-    if user_id in channel_mappings and pair_name in channel_mappings[user_id]:
-        channel_mappings[user_id][pair_name]['custom_header'] = ''
-        channel_mappings[user_id][pair_name]['custom_footer'] = ''
-        save_mappings()
-        await event.reply(f"🗑️ Custom header and footer cleared for '{pair_name}'.")
-    else:
-        await event.reply("⚠️ Pair not found.")
+@command('/setcustomfooter', r'(\S+) (.+)', "/setcustomfooter <name> <text>", pair=True)
+async def set_custom_footer(event, user_id, pair_name, mapping, text):
+    mapping['custom_footer'] = text
+    invalidate_pipeline(user_id, pair_name)
+    save_mappings()
+    await event.reply(f"📝 Custom footer set for '{pair_name}': '{text}' (added with a space before)")
 
-@client.on(events.NewMessage(pattern='(?i)^/togglementions (\S+)$'))
-async def toggle_mentions(event):
-    pair_name = event.pattern_match.group(1)
-    user_id = str(event.sender_id)
-    if user_id in channel_mappings and pair_name in channel_mappings[user_id]:
-        current_status = channel_mappings[user_id][pair_name]['remove_mentions']
-        channel_mappings[user_id][pair_name]['remove_mentions'] = not current_status
-        save_mappings()
-        status_text = "ENABLED" if not current_status else "DISABLED"
-        await event.reply(f"🔄 Mention removal {status_text} for '{pair_name}'.")
+@command('/clearcustomheaderfooter', r'(\S+)', "/clearcustomheaderfooter <name>", pair=True)
+async def clear_custom_header_footer(event, user_id, pair_name, mapping):
+    mapping['custom_header'] = ''
+    mapping['custom_footer'] = ''
+    invalidate_pipeline(user_id, pair_name)
+    save_mappings()
+    await event.reply(f"🗑️ Custom header and footer cleared for '{pair_name}'.")
+
+@command('/togglementions', r'(\S+)', "/togglementions <name>", pair=True)
+async def toggle_mentions(event, user_id, pair_name, mapping):
+    current_status = mapping['remove_mentions']
+    mapping['remove_mentions'] = not current_status
+    invalidate_pipeline(user_id, pair_name)
+    save_mappings()
+    status_text = "ENABLED" if not current_status else "DISABLED"
+    await event.reply(f"🔄 Mention removal {status_text} for '{pair_name}'.")
+
+@command('/toggleforwardheader', r'(\S+)', "/toggleforwardheader <name>", pair=True)
+async def toggle_forward_header(event, user_id, pair_name, mapping):
+    current_status = mapping.get('drop_author', True)
+    mapping['drop_author'] = not current_status
+    save_mappings()
+    status_text = "SHOWN" if current_status else "HIDDEN"
+    await event.reply(f"📨 Forwarded-from header {status_text} for '{pair_name}' (applies when the pair has no filters).")
+
+@command('/backfill', r'(\S+) (\d+)', "/backfill <name> <count>", pair=True)
+async def backfill_pair(event, user_id, pair_name, mapping, count):
+    count = min(int(count), BACKFILL_MAX_MESSAGES)
+    messages = [message async for message in client.iter_messages(peer(mapping.source_id), limit=count)]
+    messages.reverse()
+    dispatch_history(messages, ((user_id, pair_name, mapping),))
+    await event.reply(f"⏪ Backfilling {len(messages)} message(s) for '{pair_name}'.")
+
+def replay_filters(mapping, messages, slowest=5):
+    # Runs (message id, text, has media) items through a pair's filters without sending anything
+    pipeline = compile_pipeline(mapping)
+    stage_seconds = Counter()
+    block_reasons = Counter()
+    modified = 0
+    timings = []
+    for message_id, text, has_media in messages:
+        trace = MessageTrace(message_id)
+        result, block_reason = pipeline.run_traced(text, has_media, trace)
+        for stage, duration in trace.spans:
+            stage_seconds[stage.removeprefix('filter:')] += duration
+        timings.append((sum(duration for _, duration in trace.spans), message_id))
+        if block_reason:
+            block_reasons[block_reason] += 1
+        elif result != text:
+            modified += 1
+    return {
+        'messages': len(timings),
+        'blocked': sum(block_reasons.values()),
+        'block_reasons': block_reasons.most_common(5),
+        'modified': modified,
+        'stage_seconds': stage_seconds,
+        'slowest': heapq.nlargest(slowest, timings)
+    }
+
+def render_filter_report(pair_name, report):
+    count = report['messages']
+    if not count:
+        return f"🧪 No messages to test for '{pair_name}'."
+    share = lambda n: f"{n} ({n / count:.1%})"
+    lines = [
+        f"🧪 Filter test for '{pair_name}' over {count} message(s), nothing was sent:",
+        f"   Blocked: {share(report['blocked'])}",
+    ]
+    lines.extend(f"      {reason}: {n}" for reason, n in report['block_reasons'])
+    lines.append(f"   Modified: {share(report['modified'])}")
+    lines.append(f"   Unchanged: {share(count - report['blocked'] - report['modified'])}")
+    if report['stage_seconds']:
+        lines.append("⏱️ Per stage (mean per message / total):")
+        lines.extend(
+            f"   {stage}: {seconds / count * 1e6:.1f}µs / {seconds * 1000:.2f}ms"
+            for stage, seconds in report['stage_seconds'].most_common()
+        )
+    else:
+        lines.append("⏱️ The pair has no filters.")
+    lines.append("🐢 Slowest messages:")
+    lines.extend(f"   ID {message_id}: {seconds * 1e6:.1f}µs" for seconds, message_id in report['slowest'])
+    return "\n".join(lines)
+
+@command('/testfilters', r'(\S+) (\d+)', "/testfilters <name> <count>", pair=True)
+async def test_filters(event, user_id, pair_name, mapping, count):
+    count = min(int(count), FILTER_TEST_MAX_MESSAGES)
+    messages = [
+        (message.id, message.text or message.raw_text or "", bool(message.media))
+        async for message in client.iter_messages(peer(mapping.source_id), limit=count)
+        if message.text or message.raw_text or message.media
+    ]
+    report = await asyncio.get_running_loop().run_in_executor(None, replay_filters, mapping, messages)
+    await event.reply(render_filter_report(pair_name, report))
+
+async def reply_lines(event, header, lines):
+    # Splits a long listing over as many replies as Telegram's length limit needs; oversized lines are cut
+    chunk = header
+    for line in lines:
+        line = line[:MESSAGE_LENGTH_LIMIT - 1]
+        if len(chunk) + 1 + len(line) > MESSAGE_LENGTH_LIMIT:
+            await event.reply(chunk)
+            chunk = line
+        else:
+            chunk = f"{chunk}\n{line}"
+    await event.reply(chunk)
+
+@command('/trace', r'(on|off|\d+)?', "/trace [on|off|count]", owner=True)
+async def show_traces(event, user_id, option):
+    global TRACE_ENABLED
+    if option in ('on', 'off'):
+        TRACE_ENABLED = option == 'on'
+        await event.reply(f"🔬 Tracing {'ENABLED' if TRACE_ENABLED else 'DISABLED'}.")
+        return
+    count = min(max(int(option), 1), TRACE_BUFFER_SIZE) if option else 10
+    traces = list(trace_buffer)[-count:]
+    if traces:
+        await reply_lines(event, "🔬 Recent traces:", traces)
     else:
-        await event.reply("⚠️ Pair not found.")
+        status = "enabled" if TRACE_ENABLED else "disabled, use /trace on"
+        await event.reply(f"🔬 No traces recorded yet (tracing {status}).")
 
-@client.on(events.NewMessage(pattern='(?i)^/listpairs$'))
-async def list_pairs(event):
-    user_id = str(event.sender_id)
+@command('/listpairs')
+async def list_pairs(event, user_id):
     if user_id in channel_mappings and channel_mappings[user_id]:
         pairs_list = "\n".join([
             f"{name}: {data['source']} → {data['destination']} "
@@ -601,6 +2627,8 @@ async def list_pairs(event):
             f"Footer: '{data.get('footer_pattern', '')}', "
             f"Custom Header: '{data.get('custom_header', '')}', "
             f"Custom Footer: '{data.get('custom_footer', '')}', "
+            f"Forward Header: {not data.get('drop_author', True)}, "
+            f"Dedup: {data.get('dedup', 'off')}, "
             f"Blacklist: {len(data.get('blacklist', []))} words, "
             f"Blocked Sentences: {len(data.get('blocked_sentences', []))})"
             for name, data in channel_mappings[user_id].items()
@@ -609,32 +2637,26 @@ async def list_pairs(event):
     else:
         await event.reply("⚠️ No forwarding pairs found.")
 
-@client.on(events.NewMessage(pattern='(?i)^/pausepair (\S+)$'))
-async def pause_pair(event):
-    pair_name = event.pattern_match.group(1)
-    user_id = str(event.sender_id)
-    if user_id in channel_mappings and pair_name in channel_mappings[user_id]:
-        channel_mappings[user_id][pair_name]['active'] = False
-        save_mappings()
-        await event.reply(f"⏸️ Forwarding pair '{pair_name}' has been paused.")
-    else:
-        await event.reply("⚠️ Pair not found.")
+@command('/pausepair', r'(\S+)', "/pausepair <name>", pair=True)
+async def pause_pair(event, user_id, pair_name, mapping):
+    mapping['active'] = False
+    index_pair(user_id, pair_name)
+    save_mappings()
+    await event.reply(f"⏸️ Forwarding pair '{pair_name}' has been paused.")
 
-@client.on(events.NewMessage(pattern='(?i)^/startpair (\S+)$'))
-async def start_pair(event):
-    pair_name = event.pattern_match.group(1)
-    user_id = str(event.sender_id)
-    if user_id in channel_mappings and pair_name in channel_mappings[user_id]:
-        channel_mappings[user_id][pair_name]['active'] = True
-        save_mappings()
-        await event.reply(f"▶️ Forwarding pair '{pair_name}' has been activated.")
-    else:
-        await event.reply("⚠️ Pair not found.")
+@command('/startpair', r'(\S+)', "/startpair <name>", pair=True)
+async def start_pair(event, user_id, pair_name, mapping):
+    mapping['active'] = True
+    index_pair(user_id, pair_name)
+    save_mappings()
+    await event.reply(f"▶️ Forwarding pair '{pair_name}' has been activated.")
 
-@client.on(events.NewMessage(pattern='(?i)^/clearpairs$'))
-async def clear_pairs(event):
-    user_id = str(event.sender_id)
+@command('/clearpairs')
+async def clear_pairs(event, user_id):
     if user_id in channel_mappings:
+        for pair_name in channel_mappings[user_id]:
+            unindex_pair(user_id, pair_name)
+            invalidate_pipeline(user_id, pair_name, matchers=True)
         channel_mappings[user_id] = {}
         pair_stats[user_id] = {}
         save_mappings()
@@ -642,80 +2664,519 @@ async def clear_pairs(event):
     else:
         await event.reply("⚠️ No forwarding pairs found.")
 
+# Columns of an exported pair; list fields are joined with '|' in CSV, a '|' or backslash inside an item is backslash-escaped
+PAIR_FIELDS = PairConfig.FIELDS
+PAIR_FLAGS = ('active', 'remove_mentions', 'block_urls', 'drop_author')
+PAIR_LISTS = ('blacklist', 'blocked_sentences')
+
+def join_list_cell(items):
+    return '|'.join(item.replace('\\', '\\\\').replace('|', '\\|') for item in items)
+
+def split_list_cell(cell):
+    items, current, chars = [], [], iter(cell)
+    for char in chars:
+        if char == '\\':
+            current.append(next(chars, char))
+        elif char == '|':
+            items.append(''.join(current))
+            current = []
+        else:
+            current.append(char)
+    items.append(''.join(current))
+    return items
+
+def render_pairs_document(pairs, fmt):
+    if fmt == 'json':
+        return json.dumps({pair_name: mapping.to_dict() for pair_name, mapping in pairs.items()}, indent=2, ensure_ascii=False)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(('name',) + PAIR_FIELDS)
+    for pair_name, mapping in pairs.items():
+        values = mapping.to_dict().values()
+        writer.writerow([pair_name] + [join_list_cell(value) if isinstance(value, list) else value for value in values])
+    return buffer.getvalue()
+
+def parse_pairs_document(data, filename):
+    # Returns (label, pair name, fields) per pair; raises ValueError for documents that cannot be read
+    text = data.decode('utf-8-sig')
+    if filename.lower().endswith('.csv') or not text.lstrip().startswith(('{', '[')):
+        rows = csv.DictReader(io.StringIO(text))
+        return [(f"row {number}", row.pop('name', None), row) for number, row in enumerate(rows, start=2)]
+    document = json.loads(text)
+    if isinstance(document, dict):
+        return [(f"pair '{pair_name}'", pair_name, fields) for pair_name, fields in document.items()]
+    if isinstance(document, list):
+        return [
+            (f"item {number}", fields.pop('name', None) if isinstance(fields, dict) else None, fields)
+            for number, fields in enumerate(document, start=1)
+        ]
+    raise ValueError("expected an object keyed by pair name or a list of pairs")
+
+def parse_flag(value, default):
+    if isinstance(value, bool):
+        return value
+    value = str(value).strip().lower()
+    if not value:
+        return default
+    if value in ('true', 'yes', '1'):
+        return True
+    if value in ('false', 'no', '0'):
+        return False
+    raise ValueError(f"'{value}' is not yes/no")
+
+def validate_pairs(entries):
+    # Checks every pair before anything is applied; returns the new mappings and all problems found
+    pairs = {}
+    problems = []
+    for label, pair_name, fields in entries:
+        if not isinstance(fields, dict):
+            problems.append(f"{label}: expected an object")
+            continue
+        pair_name = str(pair_name or '').strip()
+        if not pair_name or WHITESPACE_PATTERN.search(pair_name):
+            problems.append(f"{label}: missing or invalid pair name")
+            continue
+        if pair_name in pairs:
+            problems.append(f"{label}: pair '{pair_name}' appears twice")
+            continue
+        unknown = [str(field) for field in fields if field not in PAIR_FIELDS]
+        if unknown:
+            problems.append(f"{label}: unknown field(s) {', '.join(unknown)}")
+            continue
+        mapping = default_mapping('', '')
+        try:
+            for field in ('source', 'destination'):
+                value = str(fields.get(field, '')).strip()
+                if not value.lstrip('-').isdigit():
+                    raise ValueError(f"{field} '{value}' is not a numeric chat id")
+                mapping[field] = value
+            for field in PAIR_FLAGS:
+                mapping[field] = parse_flag(fields.get(field, ''), mapping[field])
+            for field in ('header_pattern', 'footer_pattern', 'custom_header', 'custom_footer'):
+                mapping[field] = str(fields.get(field) or '')
+            mapping['dedup'] = str(fields.get('dedup') or 'off').strip().lower()
+            if mapping['dedup'] not in ('off', 'count', 'skip'):
+                raise ValueError("dedup must be off, count or skip")
+            for field in PAIR_LISTS:
+                value = fields.get(field) or []
+                if isinstance(value, str):
+                    value = split_list_cell(value)
+                if not isinstance(value, list):
+                    raise ValueError(f"{field} must be a list")
+                mapping[field] = [str(item).strip() for item in value if str(item).strip()]
+        except ValueError as e:
+            problems.append(f"{label}: {e}")
+            continue
+        pairs[pair_name] = mapping
+    return pairs, problems
+
+def diff_pairs(current, imported, replace):
+    added = [pair_name for pair_name in imported if pair_name not in current]
+    changed = {}
+    for pair_name, mapping in imported.items():
+        if pair_name in current:
+            fields = [field for field in PAIR_FIELDS if current[pair_name].get(field) != mapping[field]]
+            if fields:
+                changed[pair_name] = fields
+    removed = [pair_name for pair_name in current if pair_name not in imported] if replace else []
+    return added, changed, removed
+
+def format_pairs_diff(added, changed, removed, unchanged):
+    lines = []
+    if added:
+        lines.append(f"➕ Added ({len(added)}): {', '.join(added)}")
+    if changed:
+        lines.append(f"✏️ Changed ({len(changed)}):")
+        lines.extend(f"   {pair_name}: {', '.join(fields)}" for pair_name, fields in changed.items())
+    if removed:
+        lines.append(f"➖ Removed ({len(removed)}): {', '.join(removed)}")
+    lines.append(f"Unchanged: {unchanged}")
+    return "\n".join(lines)
+
+def apply_pairs(user_id, imported, added, changed, removed, matchers):
+    # Swaps in the user's new pair set with its prebuilt matchers at once, then persists and rebuilds the routes a single time
+    current = channel_mappings.get(user_id, {})
+    pairs = {pair_name: mapping for pair_name, mapping in current.items() if pair_name not in removed}
+    for pair_name, mapping in imported.items():
+        if pair_name in added or pair_name in changed:
+            pairs[pair_name] = mapping
+    for pair_name in itertools.chain(added, changed, removed):
+        invalidate_pipeline(user_id, pair_name, matchers=True)
+    pair_matchers.update(matchers)
+    channel_mappings[user_id] = pairs
+    stats = pair_stats.setdefault(user_id, {})
+    for pair_name in removed:
+        stats.pop(pair_name, None)
+    for pair_name in pairs:
+        stats.setdefault(pair_name, empty_pair_stats())
+    rebuild_routes()
+    save_mappings()
+
+@command('/exportpairs', r'(json|csv)?', "/exportpairs [json|csv]")
+async def export_pairs(event, user_id, fmt):
+    pairs = channel_mappings.get(user_id)
+    if not pairs:
+        await event.reply("⚠️ No forwarding pairs found.")
+        return
+    fmt = fmt or 'json'
+    document = io.BytesIO(render_pairs_document(pairs, fmt).encode('utf-8'))
+    document.name = f"pairs.{fmt}"
+    await event.reply(f"📤 Exported {len(pairs)} pair(s).", file=document)
+
+@command('/importpairs', r'(dry|replace|dry replace|replace dry)?', "/importpairs [dry] [replace] (attach or reply to a .json/.csv file)")
+async def import_pairs(event, user_id, options):
+    options = (options or '').split()
+    document = event.message if event.message.file else await event.get_reply_message()
+    if document is None or document.file is None:
+        await event.reply("⚠️ Send /importpairs as the caption of a .json/.csv file, or as a reply to one.")
+        return
+    if (document.file.size or 0) > IMPORT_MAX_BYTES:
+        await event.reply(f"⚠️ File is larger than {IMPORT_MAX_BYTES // 1024 // 1024} MB.")
+        return
+    data = await document.download_media(bytes)
+    try:
+        entries = parse_pairs_document(data, document.file.name or '')
+    except (ValueError, csv.Error) as e:
+        await event.reply(f"⚠️ Could not read the file: {e}")
+        return
+    imported, problems = validate_pairs(entries)
+    if problems:
+        shown = "\n".join(problems[:20])
+        more = f"\n...and {len(problems) - 20} more" if len(problems) > 20 else ""
+        await event.reply(f"⚠️ Nothing imported, {len(problems)} problem(s) found:\n{shown}{more}")
+        return
+    current = channel_mappings.get(user_id, {})
+    added, changed, removed = diff_pairs(current, imported, 'replace' in options)
+    summary = format_pairs_diff(added, changed, removed, len(imported) - len(added) - len(changed))
+    if 'dry' in options:
+        await event.reply(f"🧪 Dry run, nothing changed:\n{summary}")
+        return
+    matchers = await build_matchers({
+        (user_id, pair_name): imported[pair_name] for pair_name in itertools.chain(added, changed)
+        if imported[pair_name].blacklist or imported[pair_name].blocked_sentences
+    })
+    apply_pairs(user_id, imported, added, changed, removed, matchers)
+    await event.reply(f"📥 Imported {len(imported)} pair(s):\n{summary}")
+    chats = {imported[pair_name][role] for pair_name in itertools.chain(added, changed) for role in ('source', 'destination')}
+    await asyncio.gather(*(resolve_peer(chat) for chat in chats if int(chat) not in peer_cache))
+    missing = [chat for chat in chats if is_unresolved(chat)]
+    if missing:
+        await event.reply(f"⚠️ Could not resolve {', '.join(sorted(missing))}; those pairs will fail until they are reachable.")
+
+async def forward_to_pair(message, user_id, pair_name, mapping):
+    try:
+        success = await forward_message_with_retry(message, mapping, user_id, pair_name)
+        if not success:
+            queue_for_retry(message, user_id, pair_name)
+            logger.warning(f"Message queued due to forwarding failure for pair '{pair_name}'")
+    except Exception as e:
+        logger.error(f"Error in forward_messages for pair '{pair_name}': {e}")
+        queue_for_retry(message, user_id, pair_name)
+
+async def forward_album_to_pair(messages, user_id, pair_name, mapping):
+    try:
+        success = await forward_album_with_retry(messages, mapping, user_id, pair_name)
+    except Exception as e:
+        logger.error(f"Error forwarding album for pair '{pair_name}': {e}")
+        success = False
+    if not success:
+        for message in messages:
+            queue_for_retry(message, user_id, pair_name)
+        logger.warning(f"Album queued due to forwarding failure for pair '{pair_name}'")
+
+async def forward_batch_to_destination(entries, source, destination, drop_author):
+    try:
+        success = await forward_batch_with_retry(entries, source, destination, drop_author)
+    except Exception as e:
+        logger.error(f"Error forwarding messages to {destination}: {e}")
+        success = False
+    if not success:
+        for message, user_id, pair_name, _ in entries:
+            queue_for_retry(message, user_id, pair_name)
+        logger.warning(f"{len(entries)} message(s) queued due to forwarding failure to {destination}")
+
+def uses_fast_path(message, user_id, pair_name, mapping):
+    if not get_pipeline(user_id, pair_name, mapping).is_noop:
+        return False
+    restricted = restricted_sources.get(mapping.source_id)
+    if restricted is not None:
+        if time.monotonic() - restricted < RESTRICTED_RECHECK:
+            return False
+        del restricted_sources[mapping.source_id]
+    # Server-side forwards cannot reply, so threaded replies keep the copy path
+    reply_to = getattr(message, 'reply_to', None)
+    if reply_to and reply_to.reply_to_msg_id:
+        return message_store.get(mapping.source_id, reply_to.reply_to_msg_id, mapping.destination_id) is None
+    return True
+
+def buffer_fast_forward(message, user_id, pair_name, mapping):
+    key = (message.chat_id, mapping.destination_id, mapping.drop_author)
+    entries, timer = pending_forwards.get(key, ([], None))
+    if timer is None:
+        timer = asyncio.get_running_loop().call_later(FORWARD_COALESCE_WINDOW, flush_fast_forwards, key)
+    entries.append((message, user_id, pair_name, mapping))
+    pending_forwards[key] = (entries, timer)
+    source_progress.hold(message_keys([message]))
+    if len(entries) >= FORWARD_BATCH_LIMIT:
+        timer.cancel()
+        flush_fast_forwards(key)
+
+def flush_fast_forwards(key):
+    entries, _ = pending_forwards.pop(key, ([], None))
+    if entries:
+        source, destination, drop_author = key
+        future = send_scheduler.submit(
+            destination, forward_batch_to_destination, entries, source, destination, drop_author,
+            pairs=[(user_id, pair_name) for _, user_id, pair_name, _ in entries],
+            spill=functools.partial(spill_to_retry, [(message, user_id, pair_name) for message, user_id, pair_name, _ in entries])
+        )
+        track_delivery(future, [message for message, _, _, _ in entries], held=True)
+
+def flush_fast_forwards_before(source, destination):
+    # A copy-path job must not overtake messages still waiting in the coalescing buffer for the same lane
+    for drop_author in (True, False):
+        entries, timer = pending_forwards.get((source, destination, drop_author), (None, None))
+        if entries:
+            timer.cancel()
+            flush_fast_forwards((source, destination, drop_author))
+
+def buffer_album_part(message):
+    key = (message.chat_id, message.grouped_id)
+    parts, timer = pending_albums.get(key, ([], None))
+    if timer:
+        timer.cancel()
+    parts.append(message)
+    timer = asyncio.get_running_loop().call_later(ALBUM_WINDOW, flush_album, key)
+    pending_albums[key] = (parts, timer)
+    source_progress.hold(message_keys([message]))
+
+def flush_album(key):
+    parts, _ = pending_albums.pop(key, ([], None))
+    routes = source_routes.get(key[0])
+    if parts and routes:
+        dispatch_album(parts, routes)
+    source_progress.release(message_keys(parts))
+
+def dispatch_album(parts, routes):
+    parts.sort(key=lambda m: m.id)
+    for user_id, pair_name, mapping in routes:
+        if uses_fast_path(parts[0], user_id, pair_name, mapping):
+            # Forwarded together, the parts stay grouped as an album
+            for message in parts:
+                buffer_fast_forward(message, user_id, pair_name, mapping)
+        else:
+            flush_fast_forwards_before(parts[0].chat_id, mapping.destination_id)
+            future = send_scheduler.submit(
+                mapping.destination_id, forward_album_to_pair, parts, user_id, pair_name, mapping,
+                pairs=[(user_id, pair_name)],
+                spill=functools.partial(spill_to_retry, [(message, user_id, pair_name) for message in parts])
+            )
+            track_delivery(future, parts)
+
+def dispatch_message(message, routes):
+    if message.grouped_id:
+        buffer_album_part(message)
+        return
+    # Each destination lane runs its work in order; the caller returns right away
+    for user_id, pair_name, mapping in routes:
+        if uses_fast_path(message, user_id, pair_name, mapping):
+            buffer_fast_forward(message, user_id, pair_name, mapping)
+        else:
+            flush_fast_forwards_before(message.chat_id, mapping.destination_id)
+            future = send_scheduler.submit(
+                mapping.destination_id, forward_to_pair, message, user_id, pair_name, mapping,
+                pairs=[(user_id, pair_name)],
+                spill=functools.partial(spill_to_retry, [(message, user_id, pair_name)])
+            )
+            track_delivery(future, [message])
+
+def dispatch_history(messages, routes):
+    # Messages must be oldest first; albums are dispatched whole so each pair keeps the order
+    for group in group_album_parts(messages):
+        if group[0].grouped_id:
+            dispatch_album(group, routes)
+        else:
+            dispatch_message(group[0], routes)
+
+async def catch_up_source(source_chat, semaphore):
+    last_id = source_progress.get(source_chat)
+    async with semaphore:
+        if last_id is None:
+            # Nothing recorded for a new source: start from its latest message instead of replaying history
+            latest = await client.get_messages(peer(source_chat), limit=1)
+            if latest:
+                source_progress.start_at(source_chat, latest[0].id)
+            return
+        messages = [
+            message async for message in client.iter_messages(peer(source_chat), min_id=last_id, limit=CATCHUP_MAX_MESSAGES)
+        ]
+    if len(messages) >= CATCHUP_MAX_MESSAGES:
+        logger.warning(f"Gap in {source_chat} exceeds {CATCHUP_MAX_MESSAGES} messages, only the newest are caught up")
+    routes = source_routes.get(source_chat)
+    # Live events for these ids may have been dispatched while the history was being fetched
+    messages = [message for message in reversed(messages) if not source_progress.seen(source_chat, message.id)]
+    if not messages or not routes:
+        return
+    for message in messages:
+        source_progress.mark(source_chat, message.id)
+    # Progress is saved behind messages still in flight, so after a restart some of these were already sent
+    delivered = message_store.find_many([source_chat], [message.id for message in messages])
+    for route in routes:
+        destination = route[2].destination_id
+        missing = [message for message in messages if destination not in delivered.get((source_chat, message.id), ())]
+        if missing:
+            dispatch_history(missing, (route,))
+    source_progress.release(message_keys(messages))
+    logger.info(f"Caught up {len(messages)} missed message(s) from {source_chat}")
+
+async def catch_up_sources():
+    if catch_up_lock.locked():
+        return
+    async with catch_up_lock:
+        semaphore = asyncio.Semaphore(CATCHUP_CONCURRENCY)
+        sources = list(source_routes)
+        results = await asyncio.gather(
+            *(catch_up_source(source_chat, semaphore) for source_chat in sources),
+            return_exceptions=True
+        )
+        for source_chat, result in zip(sources, results):
+            if isinstance(result, Exception):
+                logger.error(f"Error catching up {source_chat}: {result}")
+
+def buffer_edit(message):
+    key = (message.chat_id, message.id)
+    _, timer = pending_edits.get(key, (None, None))
+    if timer:
+        timer.cancel()
+    timer = asyncio.get_running_loop().call_later(EDIT_DEBOUNCE, flush_edit, key)
+    pending_edits[key] = (message, timer)
+
+def flush_edit(key):
+    message, _ = pending_edits.pop(key, (None, None))
+    routes = source_routes.get(key[0])
+    if message is None or not routes:
+        return
+    for user_id, pair_name, mapping in routes:
+        destination = mapping.destination_id
+        # Until the original is sent, the edit queues in the same class behind it so the mapping exists when it runs
+        sent = message_store.get(key[0], key[1], destination) is not None
+        send_scheduler.submit(
+            destination, edit_for_pair, message, user_id, pair_name, mapping,
+            priority=PRIORITY_EDIT if sent else PRIORITY_NEW, pairs=[(user_id, pair_name)]
+        )
+
+async def edit_for_pair(message, user_id, pair_name, mapping):
+    try:
+        await edit_forwarded_message(message, mapping, user_id, pair_name)
+    except Exception as e:
+        logger.error(f"Error handling message edit for pair '{pair_name}': {e}")
+
 @client.on(events.NewMessage)
 async def forward_messages(event):
-    if not is_connected:
+    routes = source_routes.get(event.chat_id)
+    if not routes:
         return
-    for user_id, pairs in channel_mappings.items():
-        for pair_name, mapping in pairs.items():
-            if mapping['active'] and event.chat_id == int(mapping['source']):
-                try:
-                    success = await forward_message_with_retry(event, mapping, user_id, pair_name)
-                    if not success:
-                        message_queue.append((event, mapping, user_id, pair_name))
-                        pair_stats[user_id][pair_name]['queued'] += 1
-                        logger.warning(f"Message queued due to forwarding failure for pair '{pair_name}'")
-                except Exception as e:
-                    logger.error(f"Error in forward_messages for pair '{pair_name}': {e}")
-                    message_queue.append((event, mapping, user_id, pair_name))
-                    pair_stats[user_id][pair_name]['queued'] += 1
-                return
+    if source_progress.seen(event.chat_id, event.message.id):
+        return
+    source_progress.mark(event.chat_id, event.message.id)
+    record_arrival(event.message)
+    dispatch_message(event.message, routes)
+    source_progress.release(message_keys([event.message]))
 
 @client.on(events.MessageEdited)
 async def handle_message_edit(event):
-    if not is_connected:
+    if event.chat_id in source_routes:
+        buffer_edit(event.message)
+
+def sync_deletions(message_ids, routes_by_source):
+    found = message_store.find_many(routes_by_source, message_ids)
+    for source_chat, routes in routes_by_source.items():
+        destinations = {mapping.destination_id for _, _, mapping in routes}
+        by_destination = {}
+        deleted_sources = {}
+        for message_id in message_ids:
+            pending = pending_edits.pop((source_chat, message_id), None)
+            if pending:
+                pending[1].cancel()
+            for destination, forwarded_msg_id in found.get((source_chat, message_id), {}).items():
+                if destination in destinations:
+                    by_destination.setdefault(destination, []).append(forwarded_msg_id)
+                    deleted_sources.setdefault(destination, []).append(message_id)
+        if not by_destination:
+            continue
+        # Only the mappings of deletes actually queued go; paused pairs keep theirs
+        for destination, forwarded_msg_ids in by_destination.items():
+            queue_delete(destination, forwarded_msg_ids)
+            message_store.discard_many(source_chat, deleted_sources[destination], destination)
+        message_log.info(
+            f"Syncing deletion of {len(message_ids)} message(s) from {source_chat} to {len(by_destination)} destination(s)",
+            extra=log_fields(source=source_chat)
+        )
+
+@client.on(events.MessageDeleted)
+async def handle_message_delete(event):
+    if event.chat_id is not None:
+        routes = source_routes.get(event.chat_id)
+        if routes:
+            sync_deletions(event.deleted_ids, {event.chat_id: routes})
         return
-    for user_id, pairs in channel_mappings.items():
-        for pair_name, mapping in pairs.items():
-            if mapping['active'] and event.chat_id == int(mapping['source']):
-                try:
-                    await edit_forwarded_message(event, mapping, user_id, pair_name)
-                except Exception as e:
-                    logger.error(f"Error handling message edit for pair '{pair_name}': {e}")
-                return
+    # Telegram only names the chat for channel deletions; other message ids are unique per account
+    routes_by_source = {
+        source_chat: routes for source_chat, routes in source_routes.items()
+        if not str(source_chat).startswith('-100')
+    }
+    if routes_by_source:
+        sync_deletions(event.deleted_ids, routes_by_source)
 
-async def check_connection_status():
-    global is_connected
-    while True:
-        current_status = client.is_connected()
-        if current_status and not is_connected:
-            is_connected = True
-            logger.info("Connection established, processing queued messages...")
-            await process_message_queue()
-        elif not current_status and is_connected:
-            is_connected = False
-            logger.warning("Connection lost, messages will be queued...")
-        await asyncio.sleep(5)
+def set_connected(state):
+    if state == connected.is_set():
+        return
+    if not state:
+        connected.clear()
+        logger.warning("Connection lost, sends are held until it is back...")
+        return
+    connected.set()
+    if startup_done:
+        logger.info("Connection established, processing queued messages...")
+        asyncio.get_running_loop().create_task(recover_after_reconnect())
+
+async def recover_after_reconnect():
+    try:
+        await asyncio.gather(catch_up_sources(), process_message_queue())
+    except Exception as e:
+        logger.error(f"Error recovering after reconnect: {e}")
 
 async def send_periodic_report():
     while True:
         await asyncio.sleep(3600)  # Every hour
-        if not is_connected or not MONITOR_CHAT_ID:
+        if not connected.is_set() or not MONITOR_CHAT_ID:
             continue
         for user_id in channel_mappings:
-            report = ["📈 Hourly Forwarding Report"]
-            total_queued = len(message_queue)
-            for pair_name, data in channel_mappings[user_id].items():
-                stats = pair_stats.get(user_id, {}).get(pair_name, {'forwarded': 0, 'edited': 0, 'blocked': 0, 'queued': 0, 'last_activity': None})
-                report.append(
-                    f"\n🔹 {pair_name}: {data['source']} → {data['destination']}\n"
-                    f"   Status: {'Active' if data['active'] else 'Paused'}\n"
-                    f"   Forwarded: {stats['forwarded']}\n"
-                    f"   Edited: {stats['edited']}\n"
-                    f"   Blocked: {stats['blocked']}\n"
-                    f"   Queued: {stats['queued']}"
-                )
-            report.append(f"\n📥 Total Queued Messages: {total_queued}")
+            report = render_pair_report(user_id, "📈 Hourly Forwarding Report", detailed=False)
             try:
-                await client.send_message(MONITOR_CHAT_ID, "\n".join(report))
+                await client.send_message(MONITOR_CHAT_ID, report)
                 logger.info("Sent periodic report")
             except Exception as e:
                 logger.error(f"Error sending periodic report: {e}")
 
 async def main():
+    global METRICS_PORT
+    if WORKER_SESSION and WORKER_SESSION not in WORKER_SESSIONS:
+        logger.error(f"Worker session {WORKER_SESSION} is not in WORKER_SESSIONS")
+        return
     load_mappings()
-    asyncio.create_task(check_connection_status())
-    asyncio.create_task(send_periodic_report())
+    init_state()
+    asyncio.create_task(warm_matchers())
+    asyncio.create_task(run_retry_queue())
+    asyncio.create_task(run_state_flush())
+    if IS_PRIMARY:
+        asyncio.create_task(send_periodic_report())
+    if shard_state:
+        asyncio.create_task(run_shard_sync())
+    if METRICS_PORT:
+        if WORKER_SESSION:
+            METRICS_PORT += WORKER_SESSIONS.index(WORKER_SESSION)
+        await start_metrics_server()
     logger.info("🚀 Bot is starting...")
 
     try:
@@ -726,12 +3187,14 @@ async def main():
             code = input("Please enter the verification code you received: ")
             await client.sign_in(phone=phone, code=code)
 
-        global is_connected, MONITOR_CHAT_ID
-        is_connected = client.is_connected()
+        global startup_done, MONITOR_CHAT_ID
         MONITOR_CHAT_ID = (await client.get_me()).id
+        await warm_peer_cache()
 
-        if is_connected:
+        startup_done = True
+        if connected.is_set():
             logger.info("Initial connection established")
+            asyncio.create_task(catch_up_sources())
         else:
             logger.warning("Initial connection not established")
 
@@ -740,11 +3203,17 @@ async def main():
         logger.error(f"Fatal error: {e}")
     finally:
         logger.info("Bot is shutting down...")
-        save_mappings()
+        if IS_PRIMARY:
+            flush_mappings()
+        if message_store:
+            message_store.flush()
+            source_progress.flush()
+            content_hashes.flush()
+            state_writer.close()
 
 if __name__ == "__main__":
     try:
-        client.loop.run_until_complete(main())
+        client.loop.run_until_complete(supervise() if "--supervisor" in sys.argv else main())
     except KeyboardInterrupt:
         logger.info("Bot stopped by user")
     except Exception as e: